@@ -0,0 +1,134 @@
+import concurrent.futures
+import os
+import threading
+import time
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+def run_before_deadline(deadline, handler, payload):
+    """
+    Skip the handler if its request expired while it was queued. time.monotonic() is system
+    wide, so this also holds in process-pool workers.
+    """
+    if time.monotonic() > deadline:
+        raise DeadlineExceeded("Deadline exceeded before the command started")
+
+    return handler(payload)
+
+
+class ExecutionBackend(object):
+    """
+    Runs command handlers for the server. submit() never blocks: callers check full() first
+    and stop accepting work while max_pending jobs are outstanding. callback(result, error)
+    may be invoked from a worker thread. submit() returns a concurrent.futures.Future that
+    can cancel the job while it is still queued, or None if the job already ran.
+    """
+    MAX_PENDING = 1024
+
+    def __init__(self, max_pending=0):
+        self.max_pending = max_pending or self.MAX_PENDING
+
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def pending(self):
+        return self._pending
+
+    def full(self):
+        return self._pending >= self.max_pending
+
+    def submit(self, handler, payload, callback):
+        with self._lock:
+            self._pending += 1
+
+        return self._run(handler, payload, callback)
+
+    def shutdown(self):
+        pass
+
+    def _run(self, handler, payload, callback):
+        raise NotImplementedError
+
+    def _done(self, callback, result, error):
+        with self._lock:
+            self._pending -= 1
+
+        callback(result, error)
+
+
+class InlineBackend(ExecutionBackend):
+
+    def _run(self, handler, payload, callback):
+        try:
+            result = handler(payload)
+        except Exception as e:
+            self._done(callback, None, e)
+        else:
+            self._done(callback, result, None)
+
+
+class _PoolBackend(ExecutionBackend):
+    EXECUTOR_CLASS = None
+
+    def __init__(self, workers=0, max_pending=0):
+        super(_PoolBackend, self).__init__(max_pending)
+
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = self.EXECUTOR_CLASS(max_workers=self.workers)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def _run(self, handler, payload, callback):
+        try:
+            future = self.executor.submit(handler, payload)
+        except Exception as e:
+            self._done(callback, None, e)
+            return None
+
+        future.add_done_callback(lambda f: self._future_done(f, callback))
+
+        return future
+
+    def _future_done(self, future, callback):
+        if future.cancelled():
+            self._done(callback, None, concurrent.futures.CancelledError())
+        elif future.exception() is not None:
+            self._done(callback, None, future.exception())
+        else:
+            self._done(callback, future.result(), None)
+
+
+class ThreadPoolBackend(_PoolBackend):
+    """
+    Suited to handlers that wait on I/O or release the GIL.
+    """
+    EXECUTOR_CLASS = concurrent.futures.ThreadPoolExecutor
+
+
+class ProcessPoolBackend(_PoolBackend):
+    """
+    Runs CPU-bound handlers in parallel across cores. Handlers and payloads must be picklable,
+    i.e. handlers are module-level functions.
+    """
+    EXECUTOR_CLASS = concurrent.futures.ProcessPoolExecutor
+
+
+BACKENDS = {
+    "inline": InlineBackend,
+    "thread": ThreadPoolBackend,
+    "process": ProcessPoolBackend,
+}
+
+
+def create_backend(name, workers=0, max_pending=0):
+    if name not in BACKENDS:
+        raise ValueError("Unknown execution backend: {0}".format(name))
+
+    if name == "inline":
+        return InlineBackend(max_pending)
+
+    return BACKENDS[name](workers, max_pending)
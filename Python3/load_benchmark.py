@@ -0,0 +1,174 @@
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from maya_client_api import MayaClient
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "standalone_server.py")
+
+
+def percentile(sorted_samples, fraction):
+    if not sorted_samples:
+        return 0.0
+
+    index = min(len(sorted_samples) - 1, int(round(fraction * (len(sorted_samples) - 1))))
+
+    return sorted_samples[index]
+
+
+def start_server(port, server_args):
+    args = [sys.executable, SERVER_SCRIPT, "--port", str(port)] + server_args
+    process = subprocess.Popen(args, stdout=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 10.0
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("localhost", port), timeout=0.5).close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.05)
+
+    process.kill()
+    raise RuntimeError("standalone_server.py did not come up on port {0}".format(port))
+
+
+def stop_server(process, port):
+    client = MayaClient(framed=True)
+    if client.connect(port):
+        client.send("stop")
+        client.disconnect()
+
+    try:
+        process.wait(timeout=10.0)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def run_case(port, payload_size, concurrency, requests_per_client):
+    command = "x" * payload_size
+    clients = []
+    for _ in range(concurrency):
+        client = MayaClient(framed=True)
+        if not client.connect(port):
+            raise RuntimeError("Could not connect to port {0}".format(port))
+        clients.append(client)
+
+    latencies = [[] for _ in clients]
+    errors = [0] * len(clients)
+    barrier = threading.Barrier(len(clients) + 1)
+
+    def drive(index):
+        client = clients[index]
+        samples = latencies[index]
+        barrier.wait()
+        for _ in range(requests_per_client):
+            start = time.perf_counter()
+            if client.send(command) is None:
+                errors[index] += 1
+            samples.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=drive, args=(index,)) for index in range(len(clients))]
+    for thread in threads:
+        thread.start()
+
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    for client in clients:
+        client.disconnect()
+
+    samples = sorted(sample for client_samples in latencies for sample in client_samples)
+    total = len(samples)
+    succeeded = total - sum(errors)
+
+    return {
+        "payload_size": payload_size,
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": sum(errors),
+        "seconds": elapsed,
+        "throughput": total / elapsed,
+        "bytes_per_sec": succeeded * payload_size * 2 / elapsed,  # the echo handler returns the payload
+        "p50_ms": percentile(samples, 0.50) * 1e3,
+        "p95_ms": percentile(samples, 0.95) * 1e3,
+        "p99_ms": percentile(samples, 0.99) * 1e3,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return a description of every case whose throughput or p99 is worse than the baseline
+    by more than tolerance.
+    """
+    baseline_cases = {(case["payload_size"], case["concurrency"]): case for case in baseline["results"]}
+
+    regressions = []
+    for case in results:
+        reference = baseline_cases.get((case["payload_size"], case["concurrency"]))
+        if reference is None:
+            continue
+
+        if case["throughput"] < reference["throughput"] * (1.0 - tolerance):
+            regressions.append("{0} B x {1} clients: throughput {2:.0f} req/s, baseline {3:.0f}".format(
+                case["payload_size"], case["concurrency"], case["throughput"], reference["throughput"]))
+        if case["p99_ms"] > reference["p99_ms"] * (1.0 + tolerance):
+            regressions.append("{0} B x {1} clients: p99 {2:.3f} ms, baseline {3:.3f}".format(
+                case["payload_size"], case["concurrency"], case["p99_ms"], reference["p99_ms"]))
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load and latency benchmark for the command port")
+    parser.add_argument("--port", type=int, default=21999)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[16, 1024, 65536])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 64])
+    parser.add_argument("--requests-per-case", type=int, default=16000,
+                        help="requests per size and concurrency case, split evenly over its clients")
+    parser.add_argument("--server-args", default="", help="extra standalone_server.py arguments, e.g. \"--backend thread\"")
+    parser.add_argument("--output", help="write the results as JSON to this path")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    args = parser.parse_args()
+
+    server = start_server(args.port, args.server_args.split())
+    results = []
+    try:
+        for payload_size in args.sizes:
+            for concurrency in args.concurrency:
+                requests_per_client = max(1, args.requests_per_case // concurrency)
+                result = run_case(args.port, payload_size, concurrency, requests_per_client)
+                results.append(result)
+                print("{payload_size:>8} B  {concurrency:>4} clients  {throughput:>9.0f} req/s  "
+                      "{bytes_per_sec:>12.0f} B/s  p50 {p50_ms:7.3f}  p95 {p95_ms:7.3f}  p99 {p99_ms:7.3f} ms  "
+                      "errors {errors}".format(**result))
+    finally:
+        stop_server(server, args.port)
+
+    report = {
+        "timestamp": time.time(),
+        "python": sys.version.split()[0],
+        "server_args": args.server_args,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: {0}".format(regression))
+        if regressions:
+            sys.exit(1)
@@ -1,23 +1,184 @@
-import socket
+import argparse
+import json
 import sys
+import threading
 
-BUFFER_SIZE = 4096
+import maya_codec
+import maya_protocol
 
-prot = 21111
+PORT = 21111
 
-if len(sys.argv) > 1:
-    prot = sys.argv[1]
+WINDOW = 1024  # requests in flight
 
-maya_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # 连接
-maya_socket.connect(("localhost", prot))
+READ_SIZE = 64 * 1024
 
-maya_socket.sendall("stop".encode())  # 发送数值
-data = maya_socket.recv(BUFFER_SIZE)  # 从maya返回数值 等待回复
-print(data.decode())
-#
-# maya_socket.sendall("cmds.polySphere()".encode())  # 发送数值
-# data = maya_socket.recv(BUFFER_SIZE)  # 从maya返回数值 等待回复
-# result = eval(data.decode().replace("\x00", ""))
-# print(result)
 
-maya_socket.close()
+def read_commands(stream, framed):
+    """
+    Yield lists of command payloads, one list per read from stream, so that a burst of input
+    goes out in a single send while interactive input is sent line by line. Commands are
+    newline-delimited, or maya_protocol frames with framed=True.
+    """
+    reader = maya_protocol.FrameReader()
+    remainder = b""
+    while True:
+        data = stream.read1(READ_SIZE) if hasattr(stream, "read1") else stream.read(READ_SIZE)
+        if not data:
+            break
+
+        if framed:
+            commands = [payload for _, _, payload in reader.feed(data)]
+        else:
+            lines = (remainder + data).split(b"\n")
+            remainder = lines.pop()
+            commands = [line.rstrip(b"\r") for line in lines if line.strip()]
+        if commands:
+            yield commands
+
+    if remainder.strip():
+        yield [remainder.rstrip(b"\r")]
+
+
+class CommandRunner(object):
+    """
+    Pipelines commands over one framed connection with up to window requests in flight and
+    writes the results to output in command order, e.g.
+
+        cat commands.txt | python maya_client.py 21111 > results.txt
+
+    A sender thread reads the input while the calling thread reads replies, so results stream
+    out as they arrive instead of after the last command. Text results spanning several lines
+    are printed as their repr().
+    """
+
+    def __init__(self, sock, window=WINDOW, timeout=0.0, as_json=False, output=None, errors=None):
+        self.sock = sock
+        self.window = window
+        self.timeout = timeout
+        self.as_json = as_json
+        self.output = output or sys.stdout
+        self.errors = errors or sys.stderr
+
+        self.sent = 0
+        self.failed = 0
+        self.send_error = None
+
+        self._slots = threading.Semaphore(window)
+        self._closed = threading.Event()  # set once _receive() returns, the sender stops waiting on slots
+
+    def run(self, batches):
+        sender = threading.Thread(target=self._send, args=(batches,), daemon=True)
+        sender.start()
+        try:
+            self._receive()
+        finally:
+            self._closed.set()
+            sender.join()
+
+        if self.send_error is not None:
+            raise self.send_error
+
+        return self.failed == 0
+
+    def _send(self, batches):
+        frames = []
+        try:
+            for commands in batches:
+                for payload in commands:
+                    flags = 0
+                    if self.timeout:
+                        payload, flags = maya_protocol.add_deadline(payload, flags, self.timeout)
+                    if not self._slots.acquire(blocking=False):
+                        self._flush(frames)
+                        while not self._slots.acquire(timeout=0.1):
+                            if self._closed.is_set():
+                                return  # the connection closed, no slot comes back
+                    self.sent += 1
+                    frames.append(maya_protocol.pack_frame(payload, self.sent, flags))
+                self._flush(frames)
+        except Exception as e:
+            self.send_error = e
+        finally:
+            # an empty control request marks the end of the input; its reply ends _receive()
+            frames.append(maya_protocol.pack_frame(b"{}", 0xFFFFFFFF, maya_protocol.FLAG_CONTROL))
+            try:
+                self._flush(frames)
+            except OSError:
+                pass
+
+    def _flush(self, frames):
+        if frames:
+            self.sock.sendall(b"".join(frames))
+            del frames[:]
+
+    def _receive(self):
+        reader = maya_protocol.FrameReader()
+        replies = {}  # request_id: payload, replies that overtook an earlier one
+        written = 0
+        finished = False
+        while not (finished and written == self.sent):
+            data = self.sock.recv(reader.recv_size())
+            if not data:
+                if written == self.sent:
+                    break  # e.g. after "stop"
+                raise ConnectionError("Connection closed by server")
+
+            for request_id, flags, payload in reader.feed(data):
+                if flags & maya_protocol.FLAG_CONTROL:
+                    finished = request_id == 0xFFFFFFFF
+                elif not flags & (maya_protocol.FLAG_EVENT | maya_protocol.FLAG_STREAM):
+                    replies[request_id] = payload
+
+            lines = []
+            while written + 1 in replies:
+                written += 1
+                lines.append(self._format(written, replies.pop(written)))
+                self._slots.release()
+            if lines:
+                self.output.write("\n".join(lines) + "\n")
+                self.output.flush()
+
+    def _format(self, request_id, payload):
+        try:
+            result = maya_codec.decode(payload)
+        except maya_codec.CommandError as e:
+            self.failed += 1
+            self.errors.write("command {0}: {1}\n".format(request_id, e))
+            return json.dumps({"error": str(e)}) if self.as_json else ""
+
+        if self.as_json:
+            return json.dumps(result, default=list)
+
+        if result is None:
+            return ""
+
+        text = str(result)
+        if "\n" in text or "\r" in text:
+            return repr(text)  # one line per command, or the output no longer lines up with the input
+
+        return text
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run commands from stdin or a file on the command port, "
+                                                 "one result per line on stdout, e.g. echo stop | maya_client.py")
+    parser.add_argument("port", nargs="?", type=int, default=PORT)
+    parser.add_argument("--address", help="overrides port, e.g. unix:///tmp/maya.sock")
+    parser.add_argument("--input", default="-", help="command file, - for stdin")
+    parser.add_argument("--frames", action="store_true", help="input is length-prefixed frames, not lines")
+    parser.add_argument("--window", type=int, default=WINDOW, help="requests in flight")
+    parser.add_argument("--timeout", type=float, default=0.0, help="deadline per command in seconds")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    maya_socket = maya_protocol.create_connection(*maya_protocol.parse_address(args.address or args.port))
+    stream = sys.stdin.buffer if args.input == "-" else open(args.input, "rb")
+    try:
+        runner = CommandRunner(maya_socket, max(1, args.window), args.timeout, args.json)
+        succeeded = runner.run(read_commands(stream, args.frames))
+    finally:
+        maya_socket.close()
+        if stream is not sys.stdin.buffer:
+            stream.close()
+
+    sys.exit(0 if succeeded else 1)
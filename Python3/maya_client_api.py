@@ -1,33 +1,123 @@
+import asyncio
+import collections
+import concurrent.futures
+import json
+import queue
+import select
 import socket
+import threading
+import time
 import traceback
 
+import maya_codec
+import maya_protocol
+
+_MISSING = object()
+
 
 class MayaClient(object):
     """
+    framed=False, the default, talks to a plain Maya commandPort, whose replies are terminated
+    by a null byte; framed=True talks the length-prefixed protocol of standalone_server.py.
+
+    address selects the transport instead of the port, e.g. "unix:///tmp/maya.sock" or
+    "tcp://localhost:21111".
+
+    Framed replies come back as python objects (see maya_codec); raw replies are strings.
+    With shared_memory=True large numeric arrays are handed over in shared memory segments
+    and returned as maya_codec.SharedArray, if the server is on the same host and agrees.
+    With compression=True large frames are zlib compressed both ways, which pays off over
+    SSH tunnels and container bridges rather than on localhost.
+
+    cache is an optional query_cache.QueryCache serving the results of query() calls.
+
+    submit() returns futures and lets replies arrive in any order, so a slow command does not
+    hold up the ones behind it when the server runs commands in parallel.
+
+    subscribe() registers callbacks for events the server pushes, instead of polling.
+
+    stream() iterates over the items of a very large result as the server produces them.
+
+    timeout is the default number of seconds a request may take, None waits forever. The
+    deadline travels with the request: the server skips it if it expires while queued, and
+    the client gives up on it and asks the server to cancel it. A raw (framed=False)
+    connection cannot tell a late reply from the next one and must be reconnected after a
+    timeout.
     """
     PORT = 20231  # e.g. 20230-Maya 2023(mel), 20181-Maya 2023(python)
 
     BUFFER_SIZE = 4096
 
-    def __init__(self):
+    PIPELINE_WINDOW = 256  # max requests in flight during send_batch()
+
+    def __init__(self, framed=False, address=None, shared_memory=False, compression=False, cache=None,
+                 timeout=None):
         self.maya_socket = None
         self.port = MayaClient.PORT
+        self.address = address
+        self.framed = framed
+        self.shared_memory = shared_memory
+        self.compression = compression
+        self.cache = cache
+        self.timeout = timeout
+
+        self.options = {}  # connection options accepted by the server
+
+        self._reader = None
+        self._frames = collections.deque()
+        self._replies = {}  # request_id: deque of (flags, payload), read while waiting for another request
+        self._abandoned = set()  # request ids whose replies are dropped, after a timeout
+        self._last_request_id = 0
 
-    def connect(self, port=-1):
+        self._reader_thread = None  # started by the first submit(), then owns all reads
+        self._futures = {}  # request_id: future
+        self._streams = {}  # request_id: queue.Queue of (flags, payload), None once abandoned
+        self._send_lock = threading.Lock()
+        self._subscriptions = {}  # topic: list of callbacks
+
+    def connect(self, port=-1, address=None):
         if port >= 0:
             self.port = port
+            self.address = None
+        if address:
+            self.address = address
 
         try:
-            self.maya_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.maya_socket.connect(("localhost", self.port))
+            family, sock_address = maya_protocol.parse_address(self.address or self.port)
+            self.maya_socket = maya_protocol.create_connection(family, sock_address)
         except:
             traceback.print_exc()
             return False
 
+        self._reader = maya_protocol.FrameReader()
+        self._frames = collections.deque()
+        self._replies = {}
+        self._abandoned = set()
+        self._reader_thread = None
+        self._futures = {}
+        self._streams = {}
+        self._subscriptions = {}
+
+        self.options = {}
+        requested = {}
+        if self.shared_memory and maya_codec.SHARED_MEMORY_SUPPORTED:
+            requested["shared_memory"] = maya_codec.SHARED_MEMORY_THRESHOLD
+        if self.compression:
+            requested["compression"] = maya_protocol.COMPRESSION_THRESHOLD
+        if self.framed and requested:
+            try:
+                self.options = self._negotiate(requested)
+            except:
+                traceback.print_exc()
+                return False
+
         return True
 
     def disconnect(self):
         try:
+            if self._reader_thread is not None:
+                self.maya_socket.shutdown(socket.SHUT_RDWR)  # wakes the reader thread
+                self._reader_thread.join()
             self.maya_socket.close()
         except:
             traceback.print_exc()
@@ -35,24 +125,576 @@ class MayaClient(object):
 
         return True
 
-    def send(self, cmd):
+    def send(self, cmd, idempotent=False, timeout=None):
+        """
+        idempotent=True marks a read-only query whose result may come from self.cache. Any
+        other command may change the scene, so it clears the cache. timeout overrides
+        self.timeout for this command.
+        """
+        if self.cache is None:
+            return self._send(cmd, timeout)
+
+        if not idempotent:
+            result = self._send(cmd, timeout)
+            self.cache.invalidate()
+            return result
+
+        key = (self.address or self.port, cmd)
+        result = self.cache.get(key, _MISSING)
+        if result is _MISSING:
+            result = self._send(cmd, timeout)
+            if result is not None and not isinstance(result, maya_codec.SharedArray):
+                self.cache.put(key, result)
+
+        return result
+
+    def query(self, cmd, timeout=None):
+        return self.send(cmd, idempotent=True, timeout=timeout)
+
+    def invalidate_cache(self, cmd=None):
+        if self.cache is not None:
+            self.cache.invalidate(None if cmd is None else (self.address or self.port, cmd))
+
+    def _send(self, cmd, timeout=None):
+        if not self.framed:
+            try:
+                self.maya_socket.sendall(cmd.encode())
+            except:
+                traceback.print_exc()
+                return None
+
+            return self.recv(timeout)
+
+        return self._request(cmd.encode(), timeout=timeout)
+
+    def call(self, name, *args, timeout=None, **kwargs):
+        """
+        Call a handler registered on the server with rpc_handlers.register_handler(). Nothing
+        is compiled on the server, and numeric array arguments are sent as arrays. timeout
+        works as for send() and is not passed to the handler. Raises ValueError on a raw
+        connection, like stream() and submit().
+        """
+        if not self.framed:
+            raise ValueError("call() needs the framed protocol")
+
         try:
-            self.maya_socket.sendall(cmd.encode())
+            payload = maya_codec.encode_call(name, args, kwargs,
+                                             shared_memory_threshold=self.options.get("shared_memory", 0))
         except:
             traceback.print_exc()
             return None
 
-        return self.recv()
+        result = self._request(payload, maya_protocol.FLAG_CALL, timeout)
+        self.invalidate_cache()
+
+        return result
+
+    def stream(self, cmd, timeout=None):
+        """
+        Evaluate cmd on the server to an iterable and yield its items as they arrive, e.g.
+
+            for name in client.stream("(n for n in cmds.ls(dag=True))"):
+                ...
 
-    def recv(self):
+        The server sends the items in chunks, at most maya_protocol.STREAM_WINDOW ahead of the
+        ones taken here, so memory stays flat for any result size and other requests are served
+        while the stream is read. A failing command raises CommandError from the iteration,
+        since it cannot return None halfway through, and TimeoutError once the timeout for the
+        whole stream has passed.
+        """
+        return self._stream(cmd.encode(), 0, timeout)
+
+    def stream_call(self, name, *args, timeout=None, **kwargs):
+        """
+        stream() for a registered handler returning an iterable, see call().
+        """
+        return self._stream(maya_codec.encode_call(name, args, kwargs), maya_protocol.FLAG_CALL, timeout)
+
+    def _stream(self, payload, flags, timeout=None):
+        if not self.framed:
+            raise ValueError("stream() needs the framed protocol")
+
+        flags |= maya_protocol.FLAG_STREAM | maya_protocol.FLAG_CREDIT
+        payload, flags, deadline = self._add_deadline(payload, flags, timeout)
+        compression_threshold = self.options.get("compression", 0)
+        if self._reader_thread is None:
+            request_id = self._next_request_id()
+            maya_protocol.send_frame(self.maya_socket, payload, request_id, flags, compression_threshold)
+            chunks = None
+        else:
+            chunks = queue.Queue()  # never blocks the reader thread, the server's window bounds it
+            with self._send_lock:
+                request_id = self._next_request_id()
+                self._streams[request_id] = chunks
+                maya_protocol.send_frame(self.maya_socket, payload, request_id, flags, compression_threshold)
+
+        done = False
+        taken = 0  # chunks taken since credit was last returned
+        try:
+            while not done:
+                if chunks is None:
+                    reply_flags, data = self._recv_reply_frame(request_id, deadline)
+                else:
+                    try:
+                        reply_flags, data = chunks.get(timeout=self._remaining(deadline))
+                    except queue.Empty:
+                        raise TimeoutError("No reply before the deadline") from None
+                    if isinstance(data, Exception):
+                        done = True
+                        raise data
+
+                done = not reply_flags & maya_protocol.FLAG_STREAM
+                records = self._decode(data)  # the final frame raises CommandError for a failed stream
+                if done:
+                    break
+                taken += 1
+                if taken >= maya_protocol.STREAM_WINDOW // 2:
+                    self._return_credit(request_id, taken)
+                    taken = 0
+                for record in records:
+                    yield record
+        finally:
+            if not done:
+                self._abandon_stream(request_id, chunks)
+
+    def _return_credit(self, request_id, chunks):
+        """
+        Let the server send that many more chunks of a FLAG_CREDIT stream, the reply is dropped.
+        """
+        with self._send_lock:
+            control_id = self._next_request_id()
+            if self._reader_thread is None:
+                self._abandoned.add(control_id)
+            maya_protocol.send_frame(self.maya_socket, json.dumps({"credit": [[request_id, chunks]]}).encode(),
+                                     control_id, maya_protocol.FLAG_CONTROL)
+
+    def _abandon_stream(self, request_id, chunks):
+        """
+        The caller stopped iterating early or timed out: the server is asked to stop, and
+        whatever is still on its way is dropped.
+        """
+        self._cancel([request_id])
+        if chunks is not None:
+            try:
+                while True:
+                    chunks.get_nowait()  # frees what arrived meanwhile
+            except queue.Empty:
+                pass
+
+    def _request(self, payload, flags=0, timeout=None):
+        payload, flags, deadline = self._add_deadline(payload, flags, timeout)
+        if self._reader_thread is not None:
+            future = self._submit(payload, flags)
+            try:
+                return future.result(self._remaining(deadline))
+            except concurrent.futures.TimeoutError:
+                self._cancel([future.request_id])
+                traceback.print_exc()
+                return None
+            except:
+                traceback.print_exc()
+                return None
+
+        request_id = 0
         try:
-            data = self.maya_socket.recv(maya_client.BUFFER_SIZE)
+            request_id = self._next_request_id()
+            maya_protocol.send_frame(self.maya_socket, payload, request_id, flags, self.options.get("compression", 0))
+            data = self._recv_reply(request_id, deadline)
+            result = self._decode(data)
+        except TimeoutError:
+            self._cancel([request_id])
+            traceback.print_exc()
+            return None
         except:
             traceback.print_exc()
             return None
 
+        return result
+
+    def _add_deadline(self, payload, flags, timeout):
+        """
+        Return (payload, flags, deadline) with the timeout, or self.timeout, attached.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        if not timeout:
+            return payload, flags, None
+
+        payload, flags = maya_protocol.add_deadline(payload, flags, timeout)
+
+        return payload, flags, time.monotonic() + timeout
+
+    def _remaining(self, deadline):
+        if deadline is None:
+            return None
+
+        return max(0.0, deadline - time.monotonic())
+
+    def _cancel(self, request_ids):
+        """
+        Give up on requests: their replies are dropped and the server is asked to cancel
+        them, or skip what is left of a stream. Never raises, a broken connection surfaces
+        on the next request.
+        """
+        try:
+            with self._send_lock:
+                for request_id in request_ids:
+                    self._futures.pop(request_id, None)
+                    if request_id in self._streams:
+                        self._streams[request_id] = None
+
+                control_id = self._next_request_id()
+                if self._reader_thread is None:  # the reader thread drops unknown replies itself
+                    self._abandoned.update(request_ids)
+                    self._abandoned.add(control_id)
+                maya_protocol.send_frame(self.maya_socket, json.dumps({"cancel": list(request_ids)}).encode(),
+                                         control_id, maya_protocol.FLAG_CONTROL)
+        except:
+            traceback.print_exc()
+
+    def send_batch(self, commands, window=0, timeout=None):
+        """
+        Pipeline the commands over the connection with up to window requests in flight and
+        return the replies in command order. The commands count as mutating for the cache.
+        timeout applies to every command, and to the wait for each next reply.
+        """
+        results = self._send_batch(commands, window, timeout)
+        self.invalidate_cache()
+
+        return results
+
+    def _send_batch(self, commands, window, timeout=None):
+        if not self.framed:
+            return [self._send(cmd, timeout) for cmd in commands]
+
+        commands = list(commands)
+        window = window or self.PIPELINE_WINDOW
+        if self._reader_thread is not None:
+            return self._submit_batch(commands, window, timeout)
+
+        compression_threshold = self.options.get("compression", 0)
+
+        request_ids = []
+        results = []
+        try:
+            while len(results) < len(commands):
+                sent = len(request_ids)
+                if sent < len(commands) and sent - len(results) <= window // 2:
+                    frames = []
+                    for cmd in commands[sent:len(results) + window]:
+                        payload, flags, _ = self._add_deadline(cmd.encode(), 0, timeout)
+                        request_id = self._next_request_id()
+                        request_ids.append(request_id)
+                        frames.append(maya_protocol.pack_frame(payload, request_id, flags,
+                                                               compression_threshold=compression_threshold))
+                    self._send_pipelined(b"".join(frames))
+
+                _, _, deadline = self._add_deadline(b"", 0, timeout)
+                data = self._recv_reply(request_ids[len(results)], deadline)
+                try:
+                    results.append(self._decode(data))
+                except maya_codec.CommandError:
+                    traceback.print_exc()
+                    results.append(None)
+        except TimeoutError:
+            self._cancel(request_ids[len(results):])
+            traceback.print_exc()
+            return None
+        except:
+            traceback.print_exc()
+            return None
+
+        return results
+
+    def _submit_batch(self, commands, window, timeout=None):
+        """
+        _send_batch() once the reader thread owns the socket: the same window of requests in
+        flight, with futures in place of reading the replies here.
+        """
+        futures = []
+        results = []
+        try:
+            while len(results) < len(commands):
+                sent = len(futures)
+                if sent < len(commands) and sent - len(results) <= window // 2:
+                    futures.extend(self._submit_many([self._add_deadline(cmd.encode(), 0, timeout)[:2]
+                                                      for cmd in commands[sent:len(results) + window]]))
+
+                _, _, deadline = self._add_deadline(b"", 0, timeout)
+                try:
+                    results.append(futures[len(results)].result(self._remaining(deadline)))
+                except maya_codec.CommandError:
+                    traceback.print_exc()
+                    results.append(None)
+        except concurrent.futures.TimeoutError:
+            self._cancel([future.request_id for future in futures[len(results):]])
+            traceback.print_exc()
+            return None
+        except:
+            traceback.print_exc()
+            return None
+
+        return results
+
+    def pipeline(self):
+        return MayaPipeline(self)
+
+    def submit(self, cmd, timeout=None):
+        """
+        Send cmd without waiting and return a concurrent.futures.Future of its result. The
+        first call starts a reader thread that resolves futures as their replies arrive; from
+        then on send() and send_batch() go through futures too. Safe to call from any thread.
+
+        The timeout only travels to the server, pass it to future.result() as well. Like
+        send(), the command counts as mutating: the cache is cleared once it has run.
+        """
+        payload, flags, _ = self._add_deadline(cmd.encode(), 0, timeout)
+
+        return self._submit_many([(payload, flags)], mutating=True)[0]
+
+    def subscribe(self, topic, callback):
+        """
+        Call callback(topic, data) for every event the server pushes on topic. Callbacks run on
+        the reader thread and should hand long work off elsewhere.
+        """
+        with self._send_lock:
+            callbacks = self._subscriptions.setdefault(topic, [])
+            callbacks.append(callback)
+            if len(callbacks) > 1:
+                return True
+
+        return self._control({"subscribe": [topic]}) is not None
+
+    def unsubscribe(self, topic, callback=None):
+        with self._send_lock:
+            callbacks = self._subscriptions.get(topic, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if callback is not None and callbacks:
+                return True
+            self._subscriptions.pop(topic, None)
+
+        return self._control({"unsubscribe": [topic]}) is not None
+
+    def publish(self, topic, data=None):
+        """
+        Have the server push data to every subscriber of topic; data must be JSON serializable.
+        """
+        return self._control({"publish": [topic, data]}) is not None
+
+    def _control(self, request):
+        try:
+            return self._submit(json.dumps(request).encode(), maya_protocol.FLAG_CONTROL).result()
+        except:
+            traceback.print_exc()
+            return None
+
+    def _submit(self, payload, flags=0):
+        return self._submit_many([(payload, flags)])[0]
+
+    def _submit_many(self, requests, mutating=False):
+        """
+        Send (payload, flags) requests in one write and return a future per request. The
+        cache is cleared before the futures of mutating requests resolve.
+        """
+        if not self.framed:
+            raise ValueError("submit() needs the framed protocol")
+
+        futures = [concurrent.futures.Future() for _ in requests]
+
+        compression_threshold = self.options.get("compression", 0)
+        try:
+            with self._send_lock:
+                if self._reader_thread is None:
+                    self._reader_thread = threading.Thread(target=self._read_replies, daemon=True)
+                    self._reader_thread.start()
+
+                frames = []
+                for future, (payload, flags) in zip(futures, requests):
+                    future.request_id = self._next_request_id()
+                    future.mutating = mutating
+                    self._futures[future.request_id] = future
+                    frames.append(maya_protocol.pack_frame(payload, future.request_id, flags,
+                                                           compression_threshold=compression_threshold))
+                self.maya_socket.sendall(b"".join(frames))
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    self._futures.pop(getattr(future, "request_id", 0), None)
+                    future.set_exception(e)
+
+        return futures
+
+    def _read_replies(self):
+        error = ConnectionError("Connection closed by server")
+        try:
+            while True:
+                request_id, flags, payload = self._recv_frame()
+                if flags & maya_protocol.FLAG_EVENT:
+                    self._dispatch_event(payload)
+                    continue
+
+                chunks = self._streams.get(request_id, _MISSING)
+                if chunks is not _MISSING:
+                    if not flags & maya_protocol.FLAG_STREAM:
+                        with self._send_lock:
+                            self._streams.pop(request_id, None)
+                    if chunks is not None:
+                        chunks.put_nowait((flags, payload))
+                    continue
+
+                future = self._futures.pop(request_id, None)
+                if future is None:
+                    if not flags & maya_protocol.FLAG_CONTROL:
+                        maya_codec.discard(payload)
+                    continue
+
+                if future.mutating:
+                    self.invalidate_cache()
+                try:
+                    if flags & maya_protocol.FLAG_CONTROL:
+                        future.set_result(json.loads(payload))
+                    else:
+                        future.set_result(self._decode(payload))
+                except Exception as e:
+                    future.set_exception(e)
+        except Exception as e:
+            error = e
+        finally:
+            with self._send_lock:
+                futures, self._futures = self._futures, {}
+                streams, self._streams = self._streams, {}
+            for future in futures.values():
+                future.set_exception(error)
+            for chunks in streams.values():
+                if chunks is not None:
+                    chunks.put_nowait((0, error))
+
+    def _dispatch_event(self, payload):
+        topic, data = maya_codec.decode(payload)
+        for callback in list(self._subscriptions.get(topic, [])):
+            try:
+                callback(topic, data)
+            except:
+                traceback.print_exc()
+
+    def recv(self, timeout=None):
+        _, _, deadline = self._add_deadline(b"", 0, timeout)
+        try:
+            if self.framed:
+                data = self._recv_frame(deadline)[2]
+            else:
+                data = self._recv_raw(deadline)
+            result = self._decode(data)
+        except:
+            traceback.print_exc()
+            return None
+
+        return result
+
+    def _decode(self, data):
+        if self.framed:
+            return maya_codec.decode(data)
+
         return data.decode().replace("\x00", "")
 
+    def _next_request_id(self):
+        self._last_request_id = self._last_request_id % 0xFFFFFFFF + 1  # 0 is never used by requests
+
+        return self._last_request_id
+
+    def _negotiate(self, requested):
+        request_id = self._next_request_id()
+        maya_protocol.send_frame(self.maya_socket, json.dumps(requested).encode(), request_id,
+                                 maya_protocol.FLAG_CONTROL)
+
+        return json.loads(self._recv_reply(request_id))
+
+    def _recv_reply(self, request_id, deadline=None):
+        return self._recv_reply_frame(request_id, deadline)[1]
+
+    def _recv_reply_frame(self, request_id, deadline=None):
+        stashed = self._replies.get(request_id)
+        if stashed:
+            frame = stashed.popleft()
+            if not stashed:
+                del self._replies[request_id]
+            return frame
+
+        while True:
+            reply_id, flags, payload = self._recv_frame(deadline)
+            if reply_id == request_id:
+                return flags, payload
+            if reply_id in self._abandoned:
+                if not flags & maya_protocol.FLAG_STREAM:
+                    self._abandoned.discard(reply_id)
+                if not flags & maya_protocol.FLAG_CONTROL:
+                    maya_codec.discard(payload)
+                continue
+            self._replies.setdefault(reply_id, collections.deque()).append((flags, payload))
+
+    def _recv_frame(self, deadline=None):
+        while not self._frames:
+            self._recv_chunk(deadline)
+
+        return self._frames.popleft()
+
+    def _recv_chunk(self, deadline=None):
+        chunk = self._recv_before(deadline, self._reader.recv_size())
+        if not chunk:
+            raise ConnectionError("Connection closed by server")
+        self._frames.extend(self._reader.feed(chunk))
+
+    def _recv_before(self, deadline, size):
+        if deadline is None:
+            return self.maya_socket.recv(size)
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("No reply before the deadline") from None
+
+        self.maya_socket.settimeout(remaining)
+        try:
+            return self.maya_socket.recv(size)
+        except socket.timeout:
+            raise TimeoutError("No reply before the deadline") from None
+        finally:
+            self.maya_socket.settimeout(None)
+
+    def _send_pipelined(self, data):
+        """
+        Write data while draining replies, so that neither end stalls on a full socket buffer.
+        """
+        view = memoryview(data)
+        timeout = self.maya_socket.gettimeout()
+        self.maya_socket.setblocking(False)
+        try:
+            while view:
+                readable, writable, _ = select.select([self.maya_socket], [self.maya_socket], [])
+                if readable:
+                    try:
+                        self._recv_chunk()
+                    except BlockingIOError:
+                        pass
+                if writable:
+                    try:
+                        view = view[self.maya_socket.send(view):]
+                    except BlockingIOError:
+                        pass
+        finally:
+            self.maya_socket.settimeout(timeout)
+
+    def _recv_raw(self, deadline=None):
+        chunks = []
+        while True:
+            chunk = self._recv_before(deadline, MayaClient.BUFFER_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if chunk.endswith(b"\x00"):
+                break
+
+        return b"".join(chunks)
+
     def echo(self, text):
         cmd = "eval(\"'{0}'\")".format(text)
 
@@ -64,6 +706,333 @@ class MayaClient(object):
         return self.send(cmd)
 
 
+class MayaPipeline(object):
+    """
+    Queues commands and sends them as one pipelined batch, e.g.
+
+        with client.pipeline() as pipe:
+            pipe.send("cmds.ls()")
+            pipe.send("cmds.currentTime(q=True)")
+        print(pipe.results)
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+        self.results = None
+
+    def send(self, cmd):
+        self.commands.append(cmd)
+
+        return self
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        self.results = self.client.send_batch(commands)
+
+        return self.results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.execute()
+
+
+class AsyncMayaClient(object):
+    """
+    asyncio counterpart of MayaClient for the framed protocol. Any number of send() calls
+    may be awaited concurrently over the one connection; a background task routes every
+    reply to its request by id. Server events are consumed as async iterators, e.g.
+
+        async for topic, data in await client.subscribe("timeChanged"):
+            ...
+
+    and large results with stream(), e.g. async for name in client.stream(cmd). timeout works
+    as for MayaClient.
+    """
+    PORT = MayaClient.PORT
+
+    def __init__(self, address=None, timeout=None):
+        self.port = AsyncMayaClient.PORT
+        self.address = address
+        self.timeout = timeout
+
+        self._stream_reader = None
+        self._stream_writer = None
+        self._read_task = None
+        self._pending = {}  # request_id: future
+        self._streams = {}  # request_id: asyncio.Queue of (flags, payload), None once abandoned
+        self._last_request_id = 0
+        self._event_queues = {}  # topic: list of asyncio.Queue
+
+    async def connect(self, port=-1, address=None):
+        if port >= 0:
+            self.port = port
+            self.address = None
+        if address:
+            self.address = address
+
+        try:
+            family, sock_address = maya_protocol.parse_address(self.address or self.port)
+            if family == socket.AF_INET:
+                self._stream_reader, self._stream_writer = await asyncio.open_connection(*sock_address)
+                maya_protocol.set_low_latency(self._stream_writer.get_extra_info("socket"))
+            else:
+                self._stream_reader, self._stream_writer = await asyncio.open_unix_connection(sock_address)
+        except:
+            traceback.print_exc()
+            return False
+
+        self._read_task = asyncio.ensure_future(self._read_loop())
+
+        return True
+
+    async def disconnect(self):
+        try:
+            self._stream_writer.close()
+            await self._stream_writer.wait_closed()
+            await self._read_task
+        except Exception:
+            traceback.print_exc()
+            return False
+
+        return True
+
+    async def send(self, cmd, timeout=None):
+        try:
+            result = maya_codec.decode(await self._request(cmd.encode(), timeout=timeout))
+        except Exception:  # not CancelledError, cancelling the caller has to cancel it
+            traceback.print_exc()
+            return None
+
+        return result
+
+    async def call(self, name, *args, timeout=None, **kwargs):
+        try:
+            payload = maya_codec.encode_call(name, args, kwargs)
+            result = maya_codec.decode(await self._request(payload, maya_protocol.FLAG_CALL, timeout))
+        except Exception:
+            traceback.print_exc()
+            return None
+
+        return result
+
+    def stream(self, cmd, timeout=None):
+        """
+        Async iterator over the items of an iterable evaluated on the server, see
+        MayaClient.stream().
+        """
+        return self._stream(cmd.encode(), 0, timeout)
+
+    def stream_call(self, name, *args, timeout=None, **kwargs):
+        return self._stream(maya_codec.encode_call(name, args, kwargs), maya_protocol.FLAG_CALL, timeout)
+
+    async def _stream(self, payload, flags, timeout=None):
+        if self._read_task is None or self._read_task.done():
+            raise ConnectionError("Not connected")
+
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None
+        if timeout:
+            payload, flags = maya_protocol.add_deadline(payload, flags, timeout)
+            deadline = time.monotonic() + timeout
+
+        request_id = self._next_request_id()
+        chunks = asyncio.Queue()  # never blocks the read loop, the server's window bounds it
+        self._streams[request_id] = chunks
+        self._stream_writer.write(maya_protocol.pack_frame(
+            payload, request_id, flags | maya_protocol.FLAG_STREAM | maya_protocol.FLAG_CREDIT))
+
+        done = False
+        taken = 0  # chunks taken since credit was last returned
+        try:
+            await self._stream_writer.drain()
+            while not done:
+                remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+                reply_flags, data = await asyncio.wait_for(chunks.get(), remaining)
+                if isinstance(data, Exception):
+                    done = True
+                    raise data
+
+                done = not reply_flags & maya_protocol.FLAG_STREAM
+                records = maya_codec.decode(data)
+                if done:
+                    break
+                taken += 1
+                if taken >= maya_protocol.STREAM_WINDOW // 2:
+                    self._stream_writer.write(maya_protocol.pack_frame(
+                        json.dumps({"credit": [[request_id, taken]]}).encode(), self._next_request_id(),
+                        maya_protocol.FLAG_CONTROL))  # the reply has no future and is dropped
+                    taken = 0
+                for record in records:
+                    yield record
+        finally:
+            if not done and request_id in self._streams:
+                self._streams[request_id] = None
+                self._cancel([request_id])
+                while not chunks.empty():
+                    chunks.get_nowait()
+
+    async def subscribe(self, topic):
+        """
+        Return an async iterator of the (topic, data) events the server pushes on topic.
+        """
+        queue = asyncio.Queue()
+        queues = self._event_queues.setdefault(topic, [])
+        queues.append(queue)
+        if len(queues) == 1:
+            await self._control({"subscribe": [topic]})
+
+        return AsyncEventStream(self, topic, queue)
+
+    async def unsubscribe(self, topic, queue=None):
+        queues = self._event_queues.get(topic, [])
+        if queue in queues:
+            queues.remove(queue)
+        if queue is not None and queues:
+            return True
+
+        for queue in self._event_queues.pop(topic, []):
+            queue.put_nowait(None)
+
+        return await self._control({"unsubscribe": [topic]}) is not None
+
+    async def publish(self, topic, data=None):
+        return await self._control({"publish": [topic, data]}) is not None
+
+    async def _control(self, request):
+        try:
+            return json.loads(await self._request(json.dumps(request).encode(), maya_protocol.FLAG_CONTROL))
+        except Exception:
+            traceback.print_exc()
+            return None
+
+    async def _request(self, payload, flags=0, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        if timeout:
+            payload, flags = maya_protocol.add_deadline(payload, flags, timeout)
+
+        request_id = self._next_request_id()
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+
+        sent = False
+        try:
+            if self._read_task is None or self._read_task.done():
+                raise ConnectionError("Not connected")
+
+            self._stream_writer.write(maya_protocol.pack_frame(payload, request_id, flags))
+            sent = True
+            await self._stream_writer.drain()
+            return await asyncio.wait_for(future, timeout or None)
+        except BaseException:  # timed out, cancelled or disconnected
+            if sent and not self._read_task.done():
+                self._cancel([request_id])
+            else:
+                self._pending.pop(request_id, None)
+            raise
+
+    def _cancel(self, request_ids):
+        """
+        Ask the server to cancel requests nobody waits for anymore; the reply to this request
+        has no future either and is dropped by the read loop.
+        """
+        for request_id in request_ids:
+            self._pending.pop(request_id, None)
+
+        try:
+            self._stream_writer.write(maya_protocol.pack_frame(json.dumps({"cancel": list(request_ids)}).encode(),
+                                                               self._next_request_id(), maya_protocol.FLAG_CONTROL))
+        except:
+            traceback.print_exc()
+
+    async def send_batch(self, commands):
+        return list(await asyncio.gather(*[self.send(cmd) for cmd in commands]))
+
+    async def echo(self, text):
+        cmd = "eval(\"'{0}'\")".format(text)
+
+        return await self.send(cmd)
+
+    async def new_file(self):
+        cmd = "cmds.file(new=True, force=True)"
+
+        return await self.send(cmd)
+
+    def _next_request_id(self):
+        self._last_request_id = self._last_request_id % 0xFFFFFFFF + 1
+
+        return self._last_request_id
+
+    async def _read_loop(self):
+        frame_reader = maya_protocol.FrameReader()
+        error = ConnectionError("Connection closed by server")
+        try:
+            while True:
+                data = await self._stream_reader.read(frame_reader.recv_size())
+                if not data:
+                    break
+
+                for request_id, flags, payload in frame_reader.feed(data):
+                    if flags & maya_protocol.FLAG_EVENT:
+                        event = tuple(maya_codec.decode(payload))
+                        for queue in self._event_queues.get(event[0], []):
+                            queue.put_nowait(event)
+                        continue
+
+                    chunks = self._streams.get(request_id, _MISSING)
+                    if chunks is not _MISSING:
+                        if not flags & maya_protocol.FLAG_STREAM:
+                            del self._streams[request_id]
+                        if chunks is not None:
+                            chunks.put_nowait((flags, payload))
+                        continue
+
+                    future = self._pending.pop(request_id, None)
+                    if future and not future.done():
+                        future.set_result(payload)
+                    elif not flags & maya_protocol.FLAG_CONTROL:
+                        maya_codec.discard(payload)
+        except Exception as e:
+            error = e
+        finally:
+            pending, self._pending = self._pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            streams, self._streams = self._streams, {}
+            for chunks in streams.values():
+                if chunks is not None:
+                    chunks.put_nowait((0, error))
+            for queues in self._event_queues.values():
+                for queue in queues:
+                    queue.put_nowait(None)  # ends the event streams
+
+
+class AsyncEventStream(object):
+
+    def __init__(self, client, topic, queue):
+        self.client = client
+        self.topic = topic
+        self.queue = queue
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.queue.get()
+        if event is None:
+            raise StopAsyncIteration
+
+        return event
+
+    async def aclose(self):
+        await self.client.unsubscribe(self.topic, self.queue)
+        self.queue.put_nowait(None)
+
+
 if __name__ == "__main__":
     maya_client = MayaClient()
     if maya_client.connect():
@@ -0,0 +1,134 @@
+import collections
+import contextlib
+import select
+import threading
+import time
+
+from maya_client_api import MayaClient
+
+
+class MayaClientPool(object):
+    """
+    Thread-safe pool of connected MayaClients keyed by address, e.g.
+
+        pool = MayaClientPool()
+        with pool.connection(21111) as client:
+            client.send("cmds.ls()")
+
+    Idle connections are checked before they are handed out again and closed once they have
+    been idle for max_idle_time.
+    """
+    MAX_IDLE = 8  # idle connections kept per address
+    MAX_IDLE_TIME = 60.0  # seconds
+
+    def __init__(self, max_idle=0, max_idle_time=-1.0, client_factory=MayaClient):
+        self.max_idle = max_idle or self.MAX_IDLE
+        self.max_idle_time = self.MAX_IDLE_TIME if max_idle_time < 0 else max_idle_time
+        self.client_factory = client_factory
+
+        self._idle = collections.defaultdict(collections.deque)  # key: deque of (released time, client)
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @contextlib.contextmanager
+    def connection(self, port=-1, address=None):
+        """
+        Borrow a client for the duration of the with block. The connection is dropped rather
+        than reused if the block raises.
+        """
+        client = self.acquire(port, address)
+        try:
+            yield client
+        except:
+            self.release(client, discard=True)
+            raise
+
+        self.release(client)
+
+    def acquire(self, port=-1, address=None):
+        key = self._key(port, address)
+        while True:
+            with self._lock:
+                if self._closed:
+                    raise RuntimeError("MayaClientPool is closed")
+                idle = self._idle[key]
+                released, client = idle.pop() if idle else (0.0, None)
+
+            if client is None:
+                break
+            if time.monotonic() - released <= self.max_idle_time and self._is_alive(client):
+                return client
+            client.disconnect()
+
+        client = self.client_factory()
+        connected = client.connect(address=key) if isinstance(key, str) else client.connect(key)
+        if not connected:
+            raise ConnectionError("Could not connect to {0}".format(key))
+        client._pool_key = key
+
+        return client
+
+    def release(self, client, discard=False):
+        key = getattr(client, "_pool_key", None)
+        with self._lock:
+            if not (discard or self._closed or key is None) and len(self._idle[key]) < self.max_idle:
+                self._idle[key].append((time.monotonic(), client))
+                client = None
+
+        if client is not None:
+            client.disconnect()
+
+        self.prune()
+
+    def warm(self, count, port=-1, address=None):
+        """
+        Open connections up front so the first callers do not pay for the connect.
+        """
+        clients = [self.acquire(port, address) for _ in range(count)]
+        for client in clients:
+            self.release(client)
+
+    def prune(self):
+        """
+        Close the connections that have been idle for longer than max_idle_time.
+        """
+        expired = []
+        now = time.monotonic()
+        with self._lock:
+            for idle in self._idle.values():
+                while idle and now - idle[0][0] > self.max_idle_time:  # oldest first
+                    expired.append(idle.popleft()[1])
+
+        for client in expired:
+            client.disconnect()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            clients = [client for idle in self._idle.values() for _, client in idle]
+            self._idle.clear()
+
+        for client in clients:
+            client.disconnect()
+
+    def idle_count(self):
+        with self._lock:
+            return sum(len(idle) for idle in self._idle.values())
+
+    def _key(self, port, address):
+        if address:
+            return address
+
+        return port if port >= 0 else MayaClient.PORT
+
+    def _is_alive(self, client):
+        """
+        An idle connection must have nothing to read: readable means the server closed it or
+        sent something nobody asked for.
+        """
+        try:
+            readable, _, _ = select.select([client.maya_socket], [], [], 0)
+        except (OSError, ValueError):
+            return False
+
+        return not readable
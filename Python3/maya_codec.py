@@ -0,0 +1,231 @@
+import array
+import json
+import os
+import struct
+import sys
+
+try:
+    from multiprocessing import resource_tracker
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+# every encoded value starts with a one byte tag
+TAG_JSON = b"J"
+TAG_STR = b"S"
+TAG_BYTES = b"B"
+TAG_ARRAY = b"A"  # followed by the array typecode and the raw little-endian items
+TAG_ERROR = b"E"
+TAG_SHARED = b"M"  # followed by JSON [segment name, typecode, item count]
+
+LENGTH = struct.Struct("!I")  # prefixes every value of an encoded call
+
+ARRAY_MIN_LENGTH = 16  # shorter numeric lists are not worth the type scan
+
+ARRAY_TYPECODES = {float: "d", int: "q"}
+
+JSON_SCALARS = (str, int, float, bool, type(None))
+
+# on Windows a segment dies with the last open handle, so it cannot outlive the sender's close()
+SHARED_MEMORY_SUPPORTED = shared_memory is not None and os.name == "posix"
+
+SHARED_MEMORY_THRESHOLD = 1024 * 1024  # array bytes from which shared memory is used, once negotiated
+
+
+class CommandError(Exception):
+    """
+    Raised on the client when the command failed on the server.
+    """
+
+    def __init__(self, error_type, message):
+        super(CommandError, self).__init__("{0}: {1}".format(error_type, message))
+
+        self.error_type = error_type
+        self.message = message
+
+
+class SharedArray(object):
+    """
+    Numeric array received through a shared memory segment. values is a typed memoryview of
+    the segment, e.g. numpy.frombuffer(shared.values) wraps it without a copy. The segment is
+    unlinked on receipt and unmapped by close().
+    """
+
+    def __init__(self, name, typecode, length):
+        self._segment = None
+        self._segment = shared_memory.SharedMemory(name=name)
+        self._segment.unlink()  # the mapping stays valid until close()
+
+        itemsize = array.array(typecode).itemsize
+        self.values = self._segment.buf[:length * itemsize].cast(typecode)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def tolist(self):
+        return self.values.tolist()
+
+    def close(self):
+        if self._segment is None:
+            return
+
+        self.values.release()
+        self._segment.close()
+        self._segment = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+def encode(value, shared_memory_threshold=0):
+    """
+    shared_memory_threshold > 0 moves numeric arrays of at least that many bytes into a
+    shared memory segment; only use it when both ends are on the same host.
+    """
+    value_type = type(value)
+    if value_type is str:
+        return TAG_STR + value.encode()
+    if value_type in (bytes, bytearray, memoryview):
+        return TAG_BYTES + bytes(value)
+    if value_type is array.array:
+        return _encode_array(value, shared_memory_threshold)
+    if value_type is SharedArray:
+        values = array.array(value.values.format)
+        values.frombytes(value.values.cast("B"))
+        return _encode_array(values, shared_memory_threshold)
+    if value_type in (list, tuple) and len(value) >= ARRAY_MIN_LENGTH:
+        typecode = ARRAY_TYPECODES.get(type(value[0]))
+        if typecode and all(type(item) is type(value[0]) for item in value):
+            try:
+                return _encode_array(array.array(typecode, value), shared_memory_threshold)
+            except OverflowError:
+                pass
+
+    return TAG_JSON + json.dumps(value, separators=(",", ":"), default=str).encode()
+
+
+def encode_error(error):
+    return TAG_ERROR + json.dumps([type(error).__name__, str(error)]).encode()
+
+
+def encode_call(name, args, kwargs, **options):
+    """
+    Encode a named handler call. Calls with scalar arguments only are a single JSON list;
+    otherwise every argument is encoded on its own, so numeric arrays keep their fast path
+    (and shared memory, given the options) instead of being nested in JSON.
+    """
+    values = list(args) + list(kwargs.values())
+    if all(type(value) in JSON_SCALARS for value in values):
+        return TAG_JSON + json.dumps([name, args, kwargs], separators=(",", ":")).encode()
+
+    values = [name, list(kwargs)] + values
+    parts = [LENGTH.pack(len(values))]
+    for value in values:
+        encoded = encode(value, **options)
+        parts.append(LENGTH.pack(len(encoded)))
+        parts.append(encoded)
+
+    return b"".join(parts)
+
+
+def decode_call(data):
+    """
+    Return (name, args, kwargs) of a call encoded by encode_call().
+    """
+    if data[:1] == TAG_JSON:  # the value count of the other layout starts with a zero byte
+        return json.loads(data[1:])
+
+    view = memoryview(data)
+    count = LENGTH.unpack_from(view, 0)[0]
+    offset = LENGTH.size
+
+    values = []
+    for _ in range(count):
+        size = LENGTH.unpack_from(view, offset)[0]
+        offset += LENGTH.size
+        values.append(decode(bytes(view[offset:offset + size])))
+        offset += size
+
+    name, keys = values[0], values[1]
+    arguments = values[2:]
+    positional = len(arguments) - len(keys)
+
+    return name, arguments[:positional], dict(zip(keys, arguments[positional:]))
+
+
+def decode(data):
+    tag = data[:1]
+    if tag == TAG_STR:
+        return data[1:].decode()
+    if tag == TAG_JSON:
+        return json.loads(data[1:])
+    if tag == TAG_ARRAY:
+        return _decode_array(data).tolist()
+    if tag == TAG_BYTES:
+        return data[1:]
+    if tag == TAG_SHARED:
+        return SharedArray(*json.loads(data[1:]))
+    if tag == TAG_ERROR:
+        raise CommandError(*json.loads(data[1:]))
+
+    raise ValueError("Unknown result tag: {0!r}".format(tag))
+
+
+def discard(data):
+    """
+    Release a result that is dropped without decoding, e.g. the late reply to a request that
+    timed out: a shared memory segment is only unlinked by its receiver.
+    """
+    if data[:1] == TAG_SHARED and SHARED_MEMORY_SUPPORTED:
+        try:
+            SharedArray(*json.loads(data[1:])).close()
+        except (OSError, ValueError):
+            pass  # already gone
+
+
+def _encode_array(values, shared_memory_threshold=0):
+    if 0 < shared_memory_threshold <= len(values) * values.itemsize and SHARED_MEMORY_SUPPORTED:
+        return _encode_shared(values)
+
+    if sys.byteorder != "little":
+        values = array.array(values.typecode, values)
+        values.byteswap()
+
+    return TAG_ARRAY + values.typecode.encode() + values.tobytes()
+
+
+def _encode_shared(values):
+    size = len(values) * values.itemsize
+    try:
+        segment = shared_memory.SharedMemory(create=True, size=size, track=False)
+    except TypeError:  # python < 3.13
+        segment = shared_memory.SharedMemory(create=True, size=size)
+        resource_tracker.unregister(segment._name, "shared_memory")  # the receiver unlinks it
+
+    try:
+        segment.buf[:size] = memoryview(values).cast("B")
+    finally:
+        segment.close()
+
+    return TAG_SHARED + json.dumps([segment.name, values.typecode, len(values)]).encode()
+
+
+def _decode_array(data):
+    values = array.array(chr(data[1]))
+    values.frombytes(memoryview(data)[2:])
+    if sys.byteorder != "little":
+        values.byteswap()
+
+    return values
@@ -0,0 +1,154 @@
+import concurrent.futures
+import queue
+import threading
+import traceback
+
+from maya_client_api import MayaClient
+
+
+class MayaInstance(object):
+    """
+    One Maya/mayapy command port, served by one worker thread per connection.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.clients = []
+        self.jobs = queue.Queue()
+        self.threads = []
+
+        self.in_flight = 0  # queued and running commands, guarded by the dispatcher lock
+
+
+class MayaDispatcher(object):
+    """
+    Shards commands over several Maya/mayapy instances, e.g.
+
+        with MayaDispatcher([20231, 20232, 20233]) as dispatcher:
+            results = dispatcher.map(commands, chunk_size=50)
+
+    Every job goes to the instance with the fewest commands in flight per connection.
+    """
+
+    def __init__(self, addresses, connections_per_instance=1, client_factory=MayaClient):
+        self.instances = [MayaInstance(address) for address in addresses]
+        self.connections_per_instance = connections_per_instance
+        self.client_factory = client_factory
+
+        self._lock = threading.Lock()
+        self._running = False
+
+    def start(self):
+        for instance in self.instances:
+            for _ in range(self.connections_per_instance):
+                client = self.client_factory()
+                if isinstance(instance.address, int):
+                    connected = client.connect(instance.address)
+                else:
+                    connected = client.connect(address=instance.address)
+                if not connected:
+                    self.stop()
+                    return False
+
+                instance.clients.append(client)
+
+        self._running = True
+        for instance in self.instances:
+            for client in instance.clients:
+                thread = threading.Thread(target=self._work, args=(instance, client), daemon=True)
+                thread.start()
+                instance.threads.append(thread)
+
+        return True
+
+    def stop(self):
+        self._running = False
+        for instance in self.instances:
+            for _ in instance.threads:
+                instance.jobs.put(None)
+            for thread in instance.threads:
+                thread.join()
+            for client in instance.clients:
+                client.disconnect()
+
+            instance.threads = []
+            instance.clients = []
+
+    def submit(self, cmd):
+        """
+        Run one command on the least busy instance, returns a concurrent.futures.Future.
+        """
+        return self._submit([cmd], False)
+
+    def submit_batch(self, commands):
+        """
+        Pipeline the commands on a single instance, the future resolves to their result list.
+        """
+        return self._submit(list(commands), True)
+
+    def map(self, commands, chunk_size=1):
+        """
+        Spread the commands over all instances in chunks and return the results in order.
+        """
+        commands = list(commands)
+        if chunk_size <= 1:
+            return [future.result() for future in [self.submit(cmd) for cmd in commands]]
+
+        futures = [self.submit_batch(commands[i:i + chunk_size]) for i in range(0, len(commands), chunk_size)]
+
+        results = []
+        for future in futures:
+            results.extend(future.result())
+
+        return results
+
+    def load(self):
+        """
+        Commands in flight per instance address.
+        """
+        with self._lock:
+            return {instance.address: instance.in_flight for instance in self.instances}
+
+    def _submit(self, commands, batch):
+        if not self._running:
+            raise RuntimeError("MayaDispatcher is not running")
+
+        future = concurrent.futures.Future()
+        with self._lock:
+            instance = min(self.instances, key=lambda i: i.in_flight / max(len(i.clients), 1))
+            instance.in_flight += len(commands)
+        instance.jobs.put((future, commands, batch))
+
+        return future
+
+    def _work(self, instance, client):
+        while True:
+            job = instance.jobs.get()
+            if job is None:
+                return
+
+            future, commands, batch = job
+            if future.set_running_or_notify_cancel():
+                try:
+                    if batch:
+                        # None after a timeout or a broken connection; one None per command, as send() gives
+                        result = client.send_batch(commands) or [None] * len(commands)
+                    else:
+                        result = client.send(commands[0])
+                except Exception as e:
+                    traceback.print_exc()
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+
+            with self._lock:
+                instance.in_flight -= len(commands)
+
+    def __enter__(self):
+        if not self.start():
+            raise ConnectionError("Could not connect to every Maya instance")
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stop()
@@ -0,0 +1,181 @@
+import socket
+import struct
+import zlib
+
+HEADER = struct.Struct("!IIB")  # payload length, request id, flags
+
+FLAG_CONTROL = 0x01  # connection option negotiation, the payload is a JSON object
+FLAG_COMPRESSED = 0x02  # payload is zlib compressed, only sent once negotiated
+FLAG_EVENT = 0x04  # server push to subscribers, request id 0, the payload is a maya_codec [topic, data]
+FLAG_CALL = 0x08  # named handler call, the payload is a maya_codec.encode_call()
+FLAG_STREAM = 0x10  # on a request: stream the result; on a reply: one chunk, more frames follow
+FLAG_DEADLINE = 0x20  # the payload starts with a DEADLINE prefix
+FLAG_CREDIT = 0x40  # on a stream request: the client returns chunk credit with {"credit": [[id, chunks]]}
+
+DEADLINE = struct.Struct("!I")  # milliseconds the server may spend on the request
+
+STREAM_WINDOW = 16  # chunks of a FLAG_CREDIT stream sent ahead of the client's credit
+
+MAX_FRAME_SIZE = 1 << 30
+
+RECV_SIZE = 64 * 1024
+MAX_RECV_SIZE = 4 * 1024 * 1024
+
+# payloads up to this size are joined with their header into a single send() call
+COALESCE_SIZE = 64 * 1024
+
+COMPRESSION_THRESHOLD = 16 * 1024  # smaller payloads are never compressed
+COMPRESSION_LEVEL = 1
+
+
+def parse_address(address, default_host="localhost"):
+    """
+    Resolve "tcp://host:port", "unix:///path/to.sock", "host:port" or a bare port
+    to (socket family, socket address).
+    """
+    if isinstance(address, int):
+        return socket.AF_INET, (default_host, address)
+
+    if address.startswith("unix://"):
+        if not hasattr(socket, "AF_UNIX"):
+            raise ValueError("Unix domain sockets are not supported on this platform")
+        return socket.AF_UNIX, address[len("unix://"):]
+
+    if address.startswith("tcp://"):
+        address = address[len("tcp://"):]
+
+    host, _, port = address.rpartition(":")
+
+    return socket.AF_INET, (host or default_host, int(port))
+
+
+def create_connection(family, sock_address):
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.connect(sock_address)
+    except:
+        sock.close()
+        raise
+
+    if family == socket.AF_INET:
+        set_low_latency(sock)
+
+    return sock
+
+
+def add_deadline(payload, flags, timeout):
+    """
+    Prefix payload with the time the request may take. It is relative, counted from when the
+    server reads the request, so client and server clocks need not agree.
+    """
+    milliseconds = max(1, min(int(timeout * 1000), 0xFFFFFFFF))
+
+    return DEADLINE.pack(milliseconds) + payload, flags | FLAG_DEADLINE
+
+
+def split_deadline(payload):
+    """
+    Return (timeout in seconds, payload) of a FLAG_DEADLINE payload.
+    """
+    return DEADLINE.unpack_from(payload)[0] / 1000.0, payload[DEADLINE.size:]
+
+
+def compress_payload(payload, flags=0, compression_threshold=0):
+    """
+    Compress payload when it is at least compression_threshold bytes and zlib actually
+    shrinks it. Returns (payload, flags).
+    """
+    if 0 < compression_threshold <= len(payload):
+        compressed = zlib.compress(payload, COMPRESSION_LEVEL)
+        if len(compressed) < len(payload):
+            return compressed, flags | FLAG_COMPRESSED
+
+    return payload, flags
+
+
+def pack_frame(payload, request_id=0, flags=0, compression_threshold=0):
+    payload, flags = compress_payload(payload, flags, compression_threshold)
+
+    return HEADER.pack(len(payload), request_id, flags) + payload
+
+
+def send_frame(sock, payload, request_id=0, flags=0, compression_threshold=0):
+    payload, flags = compress_payload(payload, flags, compression_threshold)
+    if len(payload) <= COALESCE_SIZE:
+        sock.sendall(HEADER.pack(len(payload), request_id, flags) + payload)
+    else:
+        sock.sendall(HEADER.pack(len(payload), request_id, flags))
+        sock.sendall(payload)
+
+
+def set_low_latency(sock):
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (OSError, AttributeError):
+        pass
+
+
+class FrameReader(object):
+    """
+    Reassembles length-prefixed frames from an arbitrarily chunked byte stream.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._frame_size = -1
+        self._request_id = 0
+        self._flags = 0
+
+    def feed(self, data):
+        """
+        Append received bytes and return the list of (request_id, flags, payload) completed by them.
+        """
+        self._buffer += data
+
+        frames = []
+        offset = 0
+        available = len(self._buffer)
+        while True:
+            if self._frame_size < 0:
+                if available - offset < HEADER.size:
+                    break
+                self._frame_size, self._request_id, self._flags = HEADER.unpack_from(self._buffer, offset)
+                if self._frame_size > MAX_FRAME_SIZE:
+                    raise ValueError("Frame too large: {0} bytes".format(self._frame_size))
+                offset += HEADER.size
+
+            if available - offset < self._frame_size:
+                break
+
+            payload = bytes(self._buffer[offset:offset + self._frame_size])
+            if self._flags & FLAG_COMPRESSED:
+                payload = self._decompress(payload)
+                self._flags &= ~FLAG_COMPRESSED
+            frames.append((self._request_id, self._flags, payload))
+            offset += self._frame_size
+            self._frame_size = -1
+
+        if offset:
+            del self._buffer[:offset]
+
+        return frames
+
+    def _decompress(self, payload):
+        decompressor = zlib.decompressobj()
+        payload = decompressor.decompress(payload, MAX_FRAME_SIZE)
+        if decompressor.unconsumed_tail:
+            raise ValueError("Decompressed frame larger than {0} bytes".format(MAX_FRAME_SIZE))
+
+        return payload
+
+    def pending(self):
+        """
+        Number of bytes still missing from the frame being reassembled.
+        """
+        if self._frame_size < 0:
+            return HEADER.size - len(self._buffer)
+
+        return self._frame_size - len(self._buffer)
+
+    def recv_size(self, minimum=RECV_SIZE):
+        return min(max(minimum, self.pending()), MAX_RECV_SIZE)
@@ -0,0 +1,58 @@
+import collections
+import threading
+import time
+
+
+class QueryCache(object):
+    """
+    Thread-safe LRU cache of query results with a time to live, for MayaClient. Cached values
+    are shared between callers, treat them as read-only.
+    """
+    MAX_ENTRIES = 1024
+    TTL = 5.0  # seconds, 0 keeps entries until they are evicted or invalidated
+
+    def __init__(self, max_entries=0, ttl=-1.0):
+        self.max_entries = max_entries or self.MAX_ENTRIES
+        self.ttl = self.TTL if ttl < 0 else ttl
+
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = collections.OrderedDict()  # key: (expiry time, value), least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[0] and entry[0] < time.monotonic()):
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+            return entry[1]
+
+    def put(self, key, value):
+        expiry = time.monotonic() + self.ttl if self.ttl else 0
+
+        with self._lock:
+            self._entries[key] = (expiry, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """
+        Drop one entry, or everything when key is None.
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,102 @@
+import inspect
+import time
+
+import maya_codec
+
+RPC_HANDLERS = {}  # name: RpcHandler
+
+ARGUMENT_TYPES = (bool, int, float, str, list, dict)
+
+
+class RpcHandler(object):
+    """
+    A registered callable plus the converters for its annotated positional parameters, which
+    are worked out once at registration instead of on every call.
+    """
+
+    def __init__(self, name, function):
+        self.name = name
+        self.function = function
+
+        self.converters = []
+        for parameter in inspect.signature(function).parameters.values():
+            if parameter.kind not in (parameter.POSITIONAL_ONLY, parameter.POSITIONAL_OR_KEYWORD):
+                break
+            annotation = parameter.annotation
+            self.converters.append(annotation if annotation in ARGUMENT_TYPES else None)
+
+    def __call__(self, *args, **kwargs):
+        if self.converters:
+            args = [converter(arg) if converter and type(arg) is not converter else arg
+                    for converter, arg in zip(self.converters, args)] + list(args[len(self.converters):])
+
+        return self.function(*args, **kwargs)
+
+
+def register_handler(name=None):
+    """
+    Decorator registering a function as a named handler for MayaClient.call(), e.g.
+
+        @register_handler()
+        def set_frame(frame: float):
+            cmds.currentTime(frame)
+
+    Register at import time so the handlers also exist in process-pool workers.
+    """
+    def decorator(function):
+        RPC_HANDLERS[name or function.__name__] = RpcHandler(name or function.__name__, function)
+        return function
+
+    return decorator
+
+
+def call_handler(payload, **codec_options):
+    name, args, kwargs = maya_codec.decode_call(payload)
+
+    handler = RPC_HANDLERS.get(name)
+    if handler is None:
+        raise KeyError("No handler registered as {0!r}".format(name))
+
+    return maya_codec.encode(handler(*args, **kwargs), **codec_options)
+
+
+def stream_handler(payload):
+    """
+    Like call_handler() for MayaClient.stream_call(): the handler returns an iterable, usually
+    a generator, and the server encodes and sends its items in chunks.
+    """
+    name, args, kwargs = maya_codec.decode_call(payload)
+
+    handler = RPC_HANDLERS.get(name)
+    if handler is None:
+        raise KeyError("No handler registered as {0!r}".format(name))
+
+    return iter(handler(*args, **kwargs))
+
+
+@register_handler()
+def ping():
+    return "pong"
+
+
+@register_handler()
+def echo(value):
+    return value
+
+
+@register_handler()
+def sleep(seconds: float):
+    time.sleep(seconds)
+
+    return seconds
+
+
+@register_handler()
+def numbers(count: int):
+    for number in range(count):
+        yield number
+
+
+@register_handler()
+def handlers():
+    return sorted(RPC_HANDLERS)
@@ -1,30 +1,633 @@
+import argparse
+import collections
+import concurrent.futures
+import functools
+import heapq
+import itertools
+import json
+import math
+import os
+import selectors
 import socket
+import threading
+import time
+import traceback
+
+import execution_backends
+import maya_codec
+import maya_protocol
+import rpc_handlers
 
 BUFFER_SIZE = 4096
 
 PORT = 21111
 
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-    sock.bind(("localhost", PORT))
-    sock.listen()
+MAX_CLIENT_BUFFER = 4 * 1024 * 1024  # queued reply bytes per client before its reads are paused
+
+MAX_STREAMS = 16  # streamed results produced at the same time
+STREAM_CHUNK_RECORDS = 1024  # records per chunk frame of a streamed result
+STREAM_QUEUED_CHUNKS = 4  # chunk frames of one stream waiting on a client before the producer blocks
+
+DEADLINE_COMPACT_SIZE = 4096  # deadlines kept before those of finished requests are dropped
+
+COMMAND_NAMESPACE = {"math": math, "os": os}
+
+
+def echo_command(payload, **codec_options):
+    return maya_codec.encode(payload.decode())
+
+
+def eval_command(payload, **codec_options):
+    """
+    Run a python command the way Maya's python command port does: evaluate it as an
+    expression and fall back to exec for statements. The result is encoded here, in the
+    worker, rather than on the network loop; codec_options are those negotiated by the client.
+    """
+    source = payload.decode()
+    namespace = dict(COMMAND_NAMESPACE)
+    try:
+        code = compile(source, "<command>", "eval")
+    except SyntaxError:
+        exec(compile(source, "<command>", "exec"), namespace)
+        return maya_codec.encode(None)
+
+    return maya_codec.encode(eval(code, namespace), **codec_options)
+
+
+def echo_stream_command(payload):
+    return iter(payload.decode().splitlines())
+
+
+def eval_stream_command(payload):
+    """
+    Evaluate an expression to an iterable, e.g. a generator expression over cmds.ls(), whose
+    items are streamed to the client as they are produced.
+    """
+    return iter(eval(compile(payload.decode(), "<command>", "eval"), dict(COMMAND_NAMESPACE)))
+
+
+STREAM_HANDLERS = {
+    "echo": echo_stream_command,
+    "eval": eval_stream_command,
+}
+
+HANDLERS = {
+    "echo": echo_command,
+    "eval": eval_command,
+}
+
+
+class ClientConnection(object):
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+
+        self.reader = maya_protocol.FrameReader()
+        self.parked = collections.deque()  # (request_id, flags, payload) read while the backend was full
+        self.out_buffer = bytearray()
+        self.codec_options = {}  # passed to the handler, set by negotiation
+        self.compression_threshold = 0  # set by negotiation
+        self.topics = set()  # subscribed event topics
+
+        self.closing = False  # close once out_buffer is flushed and no job is in flight
+        self.closed = False
+        self.in_flight = 0
+        self.jobs = {}  # request_id: cancel callable of a job in flight, or None
+        self.events = 0  # 0 while unregistered from the selector
+
+        # taken by stream producers per chunk frame, given back once the frame is flushed
+        self.stream_credit = threading.Semaphore(STREAM_QUEUED_CHUNKS)
+        self.held_credit = 0
+        self.stream_windows = {}  # request_id: Semaphore of chunks the client has room for, FLAG_CREDIT streams
+
+
+class StandaloneServer(object):
+    """
+    Stand-in for the Maya command port: a single-threaded selectors loop that serves any
+    number of clients with non-blocking reads and writes. Commands are run by handler on the
+    execution backend; while the backend is full no client is read from and frames already
+    read wait on their connection, in order, until it has room again. Replies are written
+    in completion order and matched to their request by id on the client. Calls made with
+    MayaClient.call() skip the handler and go straight to the rpc_handlers registry.
+
+    address overrides host and port, e.g. "unix:///tmp/maya.sock" to serve a unix domain socket.
+
+    publish() pushes events to the clients subscribed to a topic, e.g. from Maya scriptJobs
+    on "timeChanged", "SelectionChanged" or "SceneOpened".
+    """
 
-    while True:
+    def __init__(self, host="localhost", port=PORT, buffer_size=BUFFER_SIZE, max_client_buffer=MAX_CLIENT_BUFFER,
+                 backlog=1024, handler=echo_command, backend=None, address=None, stream_handler=echo_stream_command,
+                 max_streams=MAX_STREAMS, stream_chunk_records=STREAM_CHUNK_RECORDS):
+        self.host = host
+        self.port = port
+        self.address = address
+        self.buffer_size = buffer_size
+        self.max_client_buffer = max_client_buffer
+        self.backlog = backlog
+        self.handler = handler
+        self.backend = backend or execution_backends.InlineBackend()
+        self.stream_handler = stream_handler
+        self.stream_chunk_records = stream_chunk_records
 
-        connection, address = sock.accept()
+        self.selector = None
+        self.server_socket = None
+        self.connections = {}  # socket: ClientConnection
+        self.subscribers = collections.defaultdict(set)  # topic: set of ClientConnection
+        self.dropped_events = 0  # events not queued for subscribers over max_client_buffer
 
-        with connection:
+        self.ready = threading.Event()  # set once the server socket is listening
+
+        self._running = False
+        self._stop_requested = False
+        self._loop_thread = None
+        self._completed = collections.deque()  # (connection, request_id, frame, done) from the backend and streams
+        self._deadlines = []  # heap of (deadline, sequence, connection, request_id)
+        self._deadline_sequence = itertools.count()
+        self._deadline_limit = DEADLINE_COMPACT_SIZE
+        self._events = collections.deque()  # (topic, data) from publish()
+        self._backend_full = False
+        self._parked = collections.deque()  # connections with parked frames, served in turn
+        # generators cannot cross into a process pool, so streams are produced on threads
+        self._stream_executor = concurrent.futures.ThreadPoolExecutor(max_streams, thread_name_prefix="stream")
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+
+    def serve_forever(self):
+        self.selector = selectors.DefaultSelector()
+
+        self.server_socket = self._create_server_socket()
+        self.server_socket.listen(self.backlog)
+        self.server_socket.setblocking(False)
+        self.ready.set()
+
+        self.selector.register(self.server_socket, selectors.EVENT_READ, None)
+        self.selector.register(self._wakeup_recv, selectors.EVENT_READ, self)
+
+        self._running = True
+        self._loop_thread = threading.get_ident()
+        try:
+            while self._running:
+                for key, mask in self.selector.select(self._select_timeout()):
+                    if key.data is None:
+                        self._accept()
+                    elif key.data is self:
+                        self._drain_wakeup()
+                    else:
+                        self._service(key.data, mask)
+
+                self._expire_deadlines()
+                self._process_completed()
+                self._process_events()
+        finally:
+            self._close_all()
+            self.backend.shutdown()
+            self._stream_executor.shutdown(wait=False, cancel_futures=True)
+
+    def _create_server_socket(self):
+        family, sock_address = maya_protocol.parse_address(self.address or self.port, self.host)
+
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        elif os.path.exists(sock_address):
+            os.unlink(sock_address)  # stale socket file of a previous run
+        sock.bind(sock_address)
+
+        return sock
+
+    def publish(self, topic, data=None):
+        """
+        Push an event to every client subscribed to topic. Safe to call from any thread.
+        """
+        self._events.append((topic, data))
+        if threading.get_ident() != self._loop_thread:
+            self._wakeup()
+
+    def shutdown(self):
+        """
+        Stop serve_forever(). Safe to call from any thread.
+        """
+        self._running = False
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            self._wakeup_send.send(b"\x00")
+        except (BlockingIOError, OSError):
+            pass
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+
+            sock.setblocking(False)
+            if sock.family == socket.AF_INET:
+                maya_protocol.set_low_latency(sock)
             print("Connection Established:{0}".format(address))
 
-            while True:
-                data = connection.recv(BUFFER_SIZE)
+            connection = ClientConnection(sock, address)
+            self.connections[sock] = connection
+            self._update_events(connection)
+
+    def _service(self, connection, mask):
+        if mask & selectors.EVENT_READ:
+            self._read(connection)
+        if mask & selectors.EVENT_WRITE and connection.sock in self.connections:
+            self._flush(connection)
+
+    def _read(self, connection):
+        try:
+            data = connection.sock.recv(connection.reader.recv_size(self.buffer_size))
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self._close(connection)
+            return
+
+        if not data:
+            self._close(connection)
+            return
+
+        try:
+            frames = connection.reader.feed(data)
+        except ValueError:
+            traceback.print_exc()
+            self._close(connection)
+            return
+
+        connection.parked.extend(frames)
+        self._dispatch_parked(connection)
+
+        self._process_completed()
+        self._flush(connection)
+
+    def _dispatch_parked(self, connection):
+        """
+        Dispatch the parked frames of connection in order until the backend is full. The rest
+        waits, with reads from the connection paused, until _process_completed() resumes it.
+        """
+        while connection.parked and not connection.closing:
+            if self.backend.full():
+                if connection not in self._parked:
+                    self._parked.append(connection)
+                return
+            self._dispatch(connection, *connection.parked.popleft())
+
+        connection.parked.clear()  # closing, what is left is never answered
+
+    def _dispatch(self, connection, request_id, flags, payload):
+        if flags & maya_protocol.FLAG_CONTROL:
+            self._control(connection, request_id, payload)
+            return
+
+        deadline = None
+        if flags & maya_protocol.FLAG_DEADLINE:
+            timeout, payload = maya_protocol.split_deadline(payload)
+            deadline = time.monotonic() + timeout
+
+        if payload.strip() == b"stop":
+            self.queue_reply(connection, request_id, maya_codec.encode("Stopping server"))
+            connection.closing = True
+            self._stop_requested = True
+            return
+
+        if flags & maya_protocol.FLAG_STREAM:
+            source = rpc_handlers.stream_handler if flags & maya_protocol.FLAG_CALL else self.stream_handler
+            cancelled = threading.Event()
+            window = None
+            if flags & maya_protocol.FLAG_CREDIT:
+                window = connection.stream_windows[request_id] = threading.Semaphore(maya_protocol.STREAM_WINDOW)
+            connection.in_flight += 1
+            connection.jobs[request_id] = cancelled.set
+            self._stream_executor.submit(self._run_stream, connection, request_id, source, payload,
+                                         deadline, cancelled, window)
+            self._add_deadline(connection, request_id, deadline)
+            return
+
+        handler = rpc_handlers.call_handler if flags & maya_protocol.FLAG_CALL else self.handler
+        if connection.codec_options:
+            handler = functools.partial(handler, **connection.codec_options)
+        if deadline is not None:
+            handler = functools.partial(execution_backends.run_before_deadline, deadline, handler)
+
+        connection.in_flight += 1
+        future = self.backend.submit(handler, payload,
+                                     lambda result, error: self._job_done(connection, request_id, result, error))
+        connection.jobs[request_id] = future.cancel if future is not None else None
+        self._add_deadline(connection, request_id, deadline)
+
+    def _add_deadline(self, connection, request_id, deadline):
+        if deadline is None:
+            return
+
+        heapq.heappush(self._deadlines, (deadline, next(self._deadline_sequence), connection, request_id))
+        if len(self._deadlines) > self._deadline_limit:
+            self._deadlines = [entry for entry in self._deadlines if entry[3] in entry[2].jobs]
+            heapq.heapify(self._deadlines)
+            self._deadline_limit = max(DEADLINE_COMPACT_SIZE, 2 * len(self._deadlines))
+
+    def _select_timeout(self):
+        if not self._deadlines:
+            return None
+
+        return max(0.0, self._deadlines[0][0] - time.monotonic())
+
+    def _expire_deadlines(self):
+        """
+        Cancel the queued jobs whose deadline has passed; jobs already running finish, and
+        their reply is dropped by a client that gave up on it.
+        """
+        now = time.monotonic()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, _, connection, request_id = heapq.heappop(self._deadlines)
+            cancel = connection.jobs.get(request_id)
+            if cancel is not None:
+                cancel()
+
+    def _cancel(self, connection, request_ids):
+        cancelled = []
+        for request_id in request_ids:
+            cancel = connection.jobs.get(request_id)
+            if cancel is not None and cancel() is not False:
+                cancelled.append(request_id)
+
+        return cancelled
+
+    def _control(self, connection, request_id, payload):
+        """
+        Accept the connection options the client asks for and that this server can honour,
+        and handle "subscribe"/"unsubscribe" topic lists, "publish" [topic, data], "cancel",
+        a list of request ids the client gave up on, and "credit", [request id, chunks] pairs
+        the client has made room for in FLAG_CREDIT streams.
+        """
+        try:
+            requested = json.loads(payload)
+        except ValueError:
+            requested = {}
+
+        for topic in requested.get("subscribe", []):
+            self.subscribers[topic].add(connection)
+            connection.topics.add(topic)
+        for topic in requested.get("unsubscribe", []):
+            self.subscribers[topic].discard(connection)
+            connection.topics.discard(topic)
+        if "publish" in requested:
+            self.publish(*requested["publish"])
+        for stream_id, chunks in requested.get("credit", []):
+            window = connection.stream_windows.get(stream_id)
+            if window is not None:
+                window.release(chunks)
+
+        accepted = {}
+        if requested.get("cancel"):
+            accepted["cancelled"] = self._cancel(connection, requested["cancel"])
+        if requested.get("shared_memory") and maya_codec.SHARED_MEMORY_SUPPORTED and self._is_local(connection):
+            accepted["shared_memory"] = int(requested["shared_memory"])
+            connection.codec_options["shared_memory_threshold"] = accepted["shared_memory"]
+        if requested.get("compression"):
+            accepted["compression"] = int(requested["compression"])
+            connection.compression_threshold = accepted["compression"]
+        if connection.topics:
+            accepted["subscribed"] = sorted(connection.topics)
+
+        self.queue_reply(connection, request_id, json.dumps(accepted).encode(), maya_protocol.FLAG_CONTROL)
+
+    def _process_events(self):
+        touched = set()
+        while self._events:
+            topic, data = self._events.popleft()
+            subscribers = self.subscribers.get(topic)
+            if not subscribers:
+                continue
+
+            payload = maya_codec.encode([topic, data])
+            for connection in subscribers:
+                if len(connection.out_buffer) >= self.max_client_buffer:
+                    self.dropped_events += 1  # a stalled subscriber must not grow without bound
+                    continue
+
+                connection.out_buffer += maya_protocol.pack_frame(
+                    payload, 0, maya_protocol.FLAG_EVENT, connection.compression_threshold)
+                touched.add(connection)
+
+        for connection in touched:
+            if connection.sock in self.connections:
+                self._flush(connection)
+
+    def _is_local(self, connection):
+        if connection.sock.family != socket.AF_INET:
+            return True
+
+        return connection.address[0].startswith("127.")
+
+    def _job_done(self, connection, request_id, result, error):
+        """
+        Called on the worker side: the reply frame is built and compressed here, off the loop.
+        """
+        if error is not None:
+            if not isinstance(error, (execution_backends.DeadlineExceeded, concurrent.futures.CancelledError)):
+                traceback.print_exception(type(error), error, error.__traceback__)
+            result = maya_codec.encode_error(error)
+
+        frame = maya_protocol.pack_frame(result, request_id, compression_threshold=connection.compression_threshold)
+
+        self._completed.append((connection, request_id, frame, True))
+        if threading.get_ident() != self._loop_thread:
+            self._wakeup()
+
+    def _run_stream(self, connection, request_id, source, payload, deadline, cancelled, window=None):
+        """
+        Runs on a stream thread: the records from source are encoded stream_chunk_records at a
+        time, each chunk a FLAG_STREAM frame, and the final frame without the flag ends the
+        stream (or carries its error). The producer blocks while its client is behind, so
+        memory stays flat whatever the size of the result: while the connection is not
+        flushed, and for FLAG_CREDIT streams while window, the client's credit, is used up.
+        The deadline and cancellation are checked between chunks.
+        """
+        error = None
+        try:
+            self._check_stream(deadline, cancelled)
+            records = []
+            for record in source(payload):
+                records.append(record)
+                if len(records) >= self.stream_chunk_records:
+                    if not self._queue_stream_chunk(connection, request_id, records, deadline, cancelled, window):
+                        break
+                    records = []
+            else:
+                if records:
+                    self._queue_stream_chunk(connection, request_id, records, deadline, cancelled, window)
+        except Exception as e:
+            error = e
+
+        self._job_done(connection, request_id, maya_codec.encode(None), error)
+
+    def _check_stream(self, deadline, cancelled):
+        if deadline is not None and time.monotonic() > deadline:
+            raise execution_backends.DeadlineExceeded("Deadline exceeded while streaming")
+        if cancelled.is_set():
+            raise concurrent.futures.CancelledError()
+
+    def _queue_stream_chunk(self, connection, request_id, records, deadline, cancelled, window=None):
+        self._check_stream(deadline, cancelled)
+        chunk = maya_codec.encode(records)  # chunks are small, never worth a shared memory segment
+        if window is not None and not self._wait_for_credit(window, connection, deadline, cancelled):
+            return False
+        if not self._wait_for_credit(connection.stream_credit, connection, deadline, cancelled):
+            return False
+
+        frame = maya_protocol.pack_frame(chunk, request_id, maya_protocol.FLAG_STREAM,
+                                         connection.compression_threshold)
+        self._completed.append((connection, request_id, frame, False))
+        self._wakeup()
+
+        return True
+
+    def _wait_for_credit(self, credit, connection, deadline, cancelled):
+        while not credit.acquire(timeout=0.5):
+            if connection.closed:
+                return False
+            self._check_stream(deadline, cancelled)
+
+        return not connection.closed
+
+    def _process_completed(self):
+        touched = set()
+        while self._completed:
+            connection, request_id, frame, done = self._completed.popleft()
+            if done:
+                connection.in_flight -= 1
+                connection.jobs.pop(request_id, None)
+                connection.stream_windows.pop(request_id, None)
+            else:
+                connection.held_credit += 1
+            if connection.sock not in self.connections:
+                continue
+
+            connection.out_buffer += frame
+            touched.add(connection)
+
+        while self._parked and not self.backend.full():
+            connection = self._parked.popleft()
+            if connection.sock in self.connections:
+                self._dispatch_parked(connection)
+                touched.add(connection)
+
+        for connection in touched:
+            if connection.sock in self.connections:
+                self._flush(connection)
+
+        backend_full = self.backend.full()
+        if backend_full != self._backend_full:
+            self._backend_full = backend_full
+            for connection in list(self.connections.values()):
+                self._update_events(connection)
+
+    def queue_reply(self, connection, request_id, reply, flags=0):
+        connection.out_buffer += maya_protocol.pack_frame(reply, request_id, flags)
+
+    def _flush(self, connection):
+        if connection.out_buffer:
+            try:
+                sent = connection.sock.send(connection.out_buffer)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self._close(connection)
+                return
+            del connection.out_buffer[:sent]
+
+        self._update_events(connection)
+
+    def _update_events(self, connection):
+        if connection.closing and not connection.out_buffer and not connection.in_flight:
+            self._close(connection)
+            return
+
+        if connection.held_credit and len(connection.out_buffer) < self.max_client_buffer:
+            for _ in range(connection.held_credit):
+                connection.stream_credit.release()
+            connection.held_credit = 0
+
+        events = 0
+        if not (connection.closing or connection.parked or self._backend_full
+                or len(connection.out_buffer) >= self.max_client_buffer):
+            events |= selectors.EVENT_READ
+        if connection.out_buffer:
+            events |= selectors.EVENT_WRITE
+
+        if events == connection.events:
+            return
+
+        if not events:
+            self.selector.unregister(connection.sock)
+        elif not connection.events:
+            self.selector.register(connection.sock, events, connection)
+        else:
+            self.selector.modify(connection.sock, events, connection)
+        connection.events = events
+
+    def _close(self, connection):
+        if self.connections.pop(connection.sock, None) is None:
+            return
+
+        connection.closed = True
+        if connection.events:
+            self.selector.unregister(connection.sock)
+        connection.sock.close()
+
+        for topic in connection.topics:
+            self.subscribers[topic].discard(connection)
+            if not self.subscribers[topic]:
+                del self.subscribers[topic]
+
+        if self._stop_requested and connection.closing:
+            self.shutdown()
+
+    def _close_all(self):
+        for connection in list(self.connections.values()):
+            self._close(connection)
+
+        self.selector.close()
+        if self.server_socket.family != socket.AF_INET:
+            os.unlink(self.server_socket.getsockname())
+        self.server_socket.close()
+        self.ready.clear()
 
-                if not data:
-                    break
 
-                if data.decode().strip() == "stop":
-                    connection.sendall("Stopping server".encode())
-                    connection.shutdown(1)
-                    connection.close()
-                    exit()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Standalone Maya command port server")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--address", help="overrides --host/--port, e.g. unix:///tmp/maya.sock")
+    parser.add_argument("--buffer-size", type=int, default=BUFFER_SIZE, help="per-client recv size")
+    parser.add_argument("--max-client-buffer", type=int, default=MAX_CLIENT_BUFFER,
+                        help="queued reply bytes per client before reading from it is paused")
+    parser.add_argument("--handler", choices=sorted(HANDLERS), default="echo")
+    parser.add_argument("--backend", choices=sorted(execution_backends.BACKENDS), default="inline")
+    parser.add_argument("--workers", type=int, default=0, help="pool size, defaults to the number of cores")
+    parser.add_argument("--max-pending", type=int, default=0, help="jobs queued on the backend before reads pause")
+    parser.add_argument("--max-streams", type=int, default=MAX_STREAMS, help="streamed results produced at once")
+    args = parser.parse_args()
 
-                connection.sendall(data)
+    backend = execution_backends.create_backend(args.backend, args.workers, args.max_pending)
+    server = StandaloneServer(args.host, args.port, args.buffer_size, args.max_client_buffer,
+                              handler=HANDLERS[args.handler], backend=backend, address=args.address,
+                              stream_handler=STREAM_HANDLERS[args.handler], max_streams=args.max_streams)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
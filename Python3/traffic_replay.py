@@ -0,0 +1,388 @@
+import argparse
+import collections
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import zlib
+
+import load_benchmark
+import maya_codec
+import maya_protocol
+
+MAGIC = b"MAYATRC1"
+
+# seconds from the start of the recording, reply latency in seconds (-1 without reply), connection,
+# request id, flags, payload length
+RECORD = struct.Struct("!ddIIBI")
+
+STORE_COMPRESSION_THRESHOLD = 256  # recorded payloads from this size are zlib compressed
+
+REPLY_TIMEOUT = 30.0  # seconds a replay waits for the last replies
+
+TrafficRecord = collections.namedtuple("TrafficRecord", "offset latency connection request_id flags payload")
+
+
+class RecordingProxy(object):
+    """
+    Sits between MayaClient and standalone_server.py (framed protocol only), forwards every
+    byte unchanged and records each request with its send time and the latency of its reply:
+
+        python traffic_replay.py record --listen 21112 --target 21111 --output farm.trc
+
+    Requests are written once their reply is through, so the file is in reply order.
+    """
+
+    def __init__(self, address, target, path):
+        self.address = address
+        self.target = target
+        self.path = path
+        self.recorded = 0
+
+        self.ready = threading.Event()  # set once the proxy is listening
+
+        self._server_socket = None
+        self._file = None
+        self._start = 0.0
+        self._pending = {}  # (connection, request_id): (offset, flags, payload)
+        self._lock = threading.Lock()
+        self._running = False
+        self._connections = 0
+        self._sockets = set()
+
+    def serve_forever(self):
+        family, sock_address = maya_protocol.parse_address(self.address)
+        self._server_socket = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        elif os.path.exists(sock_address):
+            os.unlink(sock_address)
+        self._server_socket.bind(sock_address)
+        self._server_socket.listen(128)
+        self._server_socket.settimeout(0.5)  # to notice shutdown()
+
+        self._file = open(self.path, "wb")
+        self._file.write(MAGIC)
+        self._start = time.perf_counter()
+        self._running = True
+        self.ready.set()
+        try:
+            while self._running:
+                try:
+                    client, _ = self._server_socket.accept()
+                except socket.timeout:
+                    continue
+                self._open(client)
+        finally:
+            self._server_socket.close()
+            for sock in list(self._sockets):
+                self._close_socket(sock)
+            with self._lock:
+                for (connection, request_id), (offset, flags, payload) in self._pending.items():
+                    self._write(offset, -1.0, connection, request_id, flags, payload)
+                self._pending = {}
+                self._file.close()
+            self.ready.clear()
+
+    def shutdown(self):
+        self._running = False
+
+    def _open(self, client):
+        client.settimeout(None)
+        try:
+            upstream = maya_protocol.create_connection(*maya_protocol.parse_address(self.target))
+        except OSError as e:
+            print("Could not connect to {0}: {1}".format(self.target, e))
+            client.close()
+            return
+
+        if client.family == socket.AF_INET:
+            maya_protocol.set_low_latency(client)
+
+        connection = self._connections
+        self._connections += 1
+        self._sockets.update((client, upstream))
+        threading.Thread(target=self._forward_requests, args=(connection, client, upstream), daemon=True).start()
+        threading.Thread(target=self._forward_replies, args=(connection, upstream, client), daemon=True).start()
+
+    def _forward_requests(self, connection, client, upstream):
+        reader = maya_protocol.FrameReader()
+        try:
+            while True:
+                data = client.recv(maya_protocol.RECV_SIZE)
+                if not data:
+                    break
+
+                offset = time.perf_counter() - self._start
+                upstream.sendall(data)
+                frames = reader.feed(data)
+                with self._lock:
+                    for request_id, flags, payload in frames:
+                        self._pending[(connection, request_id)] = (offset, flags, payload)
+        except (OSError, ValueError):
+            pass
+        finally:
+            try:
+                upstream.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    def _forward_replies(self, connection, upstream, client):
+        reader = maya_protocol.FrameReader()
+        try:
+            while True:
+                data = upstream.recv(maya_protocol.RECV_SIZE)
+                if not data:
+                    break
+
+                client.sendall(data)
+                now = time.perf_counter() - self._start
+                for request_id, flags, _ in reader.feed(data):
+                    if flags & (maya_protocol.FLAG_EVENT | maya_protocol.FLAG_STREAM):
+                        continue  # pushed events and stream chunks are not the end of a request
+                    with self._lock:
+                        request = self._pending.pop((connection, request_id), None)
+                        if request is not None:
+                            self._write(request[0], now - request[0], connection, request_id, request[1], request[2])
+        except (OSError, ValueError):
+            pass
+        finally:
+            self._close_socket(client)
+            self._close_socket(upstream)
+
+    def _write(self, offset, latency, connection, request_id, flags, payload):
+        if self._file.closed:
+            return
+
+        payload, flags = maya_protocol.compress_payload(payload, flags, STORE_COMPRESSION_THRESHOLD)
+        self._file.write(RECORD.pack(offset, latency, connection, request_id, flags, len(payload)))
+        self._file.write(payload)
+        self.recorded += 1
+
+    def _close_socket(self, sock):
+        self._sockets.discard(sock)
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+
+def load_recording(path):
+    """
+    Return the TrafficRecords of a recording sorted by send time.
+    """
+    records = []
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{0} is not a traffic recording".format(path))
+
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break
+            offset, latency, connection, request_id, flags, size = RECORD.unpack(header)
+            payload = f.read(size)
+            if flags & maya_protocol.FLAG_COMPRESSED:
+                payload = zlib.decompress(payload)
+                flags &= ~maya_protocol.FLAG_COMPRESSED
+            records.append(TrafficRecord(offset, latency, connection, request_id, flags, payload))
+
+    records.sort(key=lambda record: record.offset)
+
+    return records
+
+
+class _ReplayConnection(object):
+
+    def __init__(self, address):
+        self.sock = maya_protocol.create_connection(*maya_protocol.parse_address(address))
+        self.sent = {}  # request_id: send time
+        self.latencies = {}  # request_id: latency
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+
+        self.thread = threading.Thread(target=self._read_replies, daemon=True)
+        self.thread.start()
+
+    def send(self, record):
+        with self.lock:
+            self.sent[record.request_id] = time.perf_counter()
+        maya_protocol.send_frame(self.sock, record.payload, record.request_id, record.flags)
+
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while self.sent and self.done.wait(max(0.0, deadline - time.monotonic())):
+                pass
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.thread.join()
+        self.sock.close()
+
+    def _read_replies(self):
+        reader = maya_protocol.FrameReader()
+        try:
+            while True:
+                data = self.sock.recv(reader.recv_size())
+                if not data:
+                    break
+
+                now = time.perf_counter()
+                for request_id, flags, payload in reader.feed(data):
+                    if flags & (maya_protocol.FLAG_EVENT | maya_protocol.FLAG_STREAM):
+                        continue
+                    if not flags & maya_protocol.FLAG_CONTROL:
+                        maya_codec.discard(payload)  # replies are only timed, never decoded
+                    with self.lock:
+                        sent = self.sent.pop(request_id, None)
+                        if sent is not None:
+                            self.latencies[request_id] = now - sent
+                        if not self.sent:
+                            self.done.notify_all()
+        except (OSError, ValueError):
+            pass
+
+
+def replay(records, address, speed=1.0, reply_timeout=REPLY_TIMEOUT):
+    """
+    Play records back against address, one connection per recorded connection and with the
+    recorded request ids. Requests are sent open loop at their recorded time divided by
+    speed, or back to back with speed=0, without waiting for replies. "stop" requests are
+    left out. Returns (the latency per record or None, seconds taken, max send lag).
+    """
+    connections = {}
+    lag = 0.0
+    start = time.perf_counter()
+    try:
+        for record in records:
+            if record.payload.strip() == b"stop":
+                continue
+
+            if speed:
+                delay = start + record.offset / speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    lag = max(lag, -delay)
+
+            connection = connections.get(record.connection)
+            if connection is None:
+                connection = connections[record.connection] = _ReplayConnection(address)
+            connection.send(record)
+
+        for connection in connections.values():
+            connection.wait(reply_timeout)
+        elapsed = time.perf_counter() - start
+    finally:
+        for connection in connections.values():
+            connection.close()
+
+    latencies = []
+    for record in records:
+        connection = connections.get(record.connection)
+        latencies.append(connection.latencies.get(record.request_id) if connection else None)
+
+    return latencies, elapsed, lag
+
+
+def summarize(latencies):
+    samples = sorted(latency for latency in latencies if latency is not None and latency >= 0)
+
+    return {
+        "requests": len(samples),
+        "p50_ms": load_benchmark.percentile(samples, 0.50) * 1e3,
+        "p95_ms": load_benchmark.percentile(samples, 0.95) * 1e3,
+        "p99_ms": load_benchmark.percentile(samples, 0.99) * 1e3,
+        "max_ms": (samples[-1] if samples else 0.0) * 1e3,
+    }
+
+
+def parse_target(text):
+    return int(text) if text.isdigit() else text
+
+
+def run_replay(args):
+    records = load_recording(args.recording)
+    if not records:
+        print("{0} holds no requests".format(args.recording))
+        return 1
+
+    server = None
+    if args.serve:
+        server = load_benchmark.start_server(int(args.target), ["--handler", args.serve] + args.server_args.split())
+    try:
+        latencies, elapsed, lag = replay(records, parse_target(args.target), args.speed, args.reply_timeout)
+    finally:
+        if server is not None:
+            load_benchmark.stop_server(server, int(args.target))
+
+    recorded = summarize([record.latency for record in records])
+    replayed = summarize(latencies)
+    report = {
+        "recording": args.recording,
+        "speed": args.speed,
+        "seconds": elapsed,
+        "recorded_seconds": records[-1].offset - records[0].offset,
+        "throughput": replayed["requests"] / elapsed if elapsed else 0.0,
+        "max_send_lag_ms": lag * 1e3,
+        "unanswered": sum(1 for latency in latencies if latency is None),
+        "recorded": recorded,
+        "replayed": replayed,
+    }
+
+    print("{0} requests over {1:.2f} s (recorded {2:.2f} s) at {3}, {4:.0f} req/s, send lag up to {5:.1f} ms, "
+          "{6} unanswered".format(len(records), elapsed, report["recorded_seconds"],
+                                  "{0:g}x".format(args.speed) if args.speed else "max speed",
+                                  report["throughput"], report["max_send_lag_ms"], report["unanswered"]))
+    for key in ("p50_ms", "p95_ms", "p99_ms", "max_ms"):
+        change = replayed[key] / recorded[key] if recorded[key] else 0.0
+        print("{0:<7} recorded {1:9.3f} ms  replayed {2:9.3f} ms  x{3:.2f}".format(
+            key[:-3], recorded[key], replayed[key], change))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    return 0
+
+
+def run_record(args):
+    proxy = RecordingProxy(parse_target(args.listen), parse_target(args.target), args.output)
+    print("Recording {0} -> {1} into {2}, Ctrl+C to stop".format(args.listen, args.target, args.output))
+    try:
+        proxy.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print("{0} requests recorded".format(proxy.recorded))
+
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record command port traffic and replay it")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = commands.add_parser("record", help="run a recording proxy in front of a server")
+    record_parser.add_argument("--listen", default="21112", help="port or address the clients connect to")
+    record_parser.add_argument("--target", default="21111", help="port or address of the server")
+    record_parser.add_argument("--output", default="traffic.trc")
+
+    replay_parser = commands.add_parser("replay", help="play a recording back and compare latencies")
+    replay_parser.add_argument("recording")
+    replay_parser.add_argument("--target", default="21111", help="port or address of the server")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="time multiplier, 0 replays at max speed")
+    replay_parser.add_argument("--serve", choices=["echo", "eval"],
+                               help="start standalone_server.py with this mock handler on the --target port")
+    replay_parser.add_argument("--server-args", default="", help="extra standalone_server.py arguments for --serve")
+    replay_parser.add_argument("--reply-timeout", type=float, default=REPLY_TIMEOUT)
+    replay_parser.add_argument("--output", help="write the report as JSON to this path")
+    args = parser.parse_args()
+
+    sys.exit(run_record(args) if args.command == "record" else run_replay(args))
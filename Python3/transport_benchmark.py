@@ -0,0 +1,84 @@
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from maya_client_api import MayaClient
+from standalone_server import StandaloneServer
+
+
+def start_server(address):
+    server = StandaloneServer(address=address)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.ready.wait()
+
+    return server, thread
+
+
+def connect(address):
+    client = MayaClient(framed=True, address=address)
+    if not client.connect(address=address):
+        raise RuntimeError("Could not connect to {0}".format(address))
+
+    return client
+
+
+def measure_latency(client, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        client.send("ping")
+        samples.append(time.perf_counter() - start)
+
+    samples.sort()
+
+    return samples[len(samples) // 2], samples[int(len(samples) * 0.99)]
+
+
+def measure_throughput(client, payload_size, count):
+    commands = ["x" * payload_size] * count
+
+    start = time.perf_counter()
+    client.send_batch(commands)
+    elapsed = time.perf_counter() - start
+
+    return count / elapsed, payload_size * count * 2 / elapsed  # replies echo the payload
+
+
+def run(iterations, payload_sizes, batch_bytes):
+    socket_path = os.path.join(tempfile.gettempdir(), "maya_transport_benchmark_{0}.sock".format(os.getpid()))
+    transports = [
+        ("tcp", "tcp://localhost:0"),
+        ("unix", "unix://" + socket_path),
+    ]
+
+    for name, address in transports:
+        server, thread = start_server(address)
+        if name == "tcp":
+            address = "tcp://localhost:{0}".format(server.server_socket.getsockname()[1])
+        client = connect(address)
+
+        p50, p99 = measure_latency(client, iterations)
+        print("{0:<5} round trip   p50 {1:8.1f} us   p99 {2:8.1f} us".format(name, p50 * 1e6, p99 * 1e6))
+
+        for payload_size in payload_sizes:
+            count = max(1, batch_bytes // payload_size)
+            messages_per_sec, bytes_per_sec = measure_throughput(client, payload_size, count)
+            print("{0:<5} {1:>9} B x {2:<6} {3:10.0f} msg/s {4:10.1f} MB/s".format(
+                name, payload_size, count, messages_per_sec, bytes_per_sec / 1e6))
+
+        client.disconnect()
+        server.shutdown()
+        thread.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare TCP and unix domain socket transports")
+    parser.add_argument("--iterations", type=int, default=5000, help="round trips for the latency test")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[16, 1024, 65536, 1048576], help="payload sizes")
+    parser.add_argument("--batch-bytes", type=int, default=32 * 1024 * 1024, help="bytes sent per throughput test")
+    args = parser.parse_args()
+
+    run(args.iterations, args.sizes, args.batch_bytes)
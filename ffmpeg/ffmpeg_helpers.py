@@ -1,23 +1,256 @@
+import concurrent.futures
+import os
+import shutil
 import subprocess
+import tempfile
+import time
+
+import image_sequences
+import transcode_cache
 
 FFMPEG_PATH = "P:/ffmpeg/bin/ffmpeg.exe"
 
+THREADS_PER_JOB = 4  # ffmpeg -threads of each encode in a batch
+
+GOP_SIZE = 48  # keyframe interval of segmented encodes, segments start on a multiple of it
+
+
+class EncodeResult(object):
+
+    def __init__(self, output_path, returncode, seconds, error=""):
+        self.output_path = output_path
+        self.returncode = returncode
+        self.seconds = seconds
+        self.error = error  # ffmpeg's error output when it failed
+
+    @property
+    def ok(self):
+        return self.returncode == 0
 
-def encode_image_sequence(image_seq_path, output_path, framerate=24, crf=21, preset="ultrafast", audio_path=None):
-    ffmpeg_cmd = FFMPEG_PATH
-    ffmpeg_cmd += ' -y '
-    ffmpeg_cmd += ' -framerate {0}'.format(framerate)
-    ffmpeg_cmd += ' -i {0}'.format(image_seq_path)
+    def __repr__(self):
+        return "EncodeResult({0!r}, returncode={1}, seconds={2:.2f})".format(self.output_path, self.returncode,
+                                                                          self.seconds)
+
+
+def build_encode_args(image_seq_path, output_path, framerate=24, crf=21, preset="ultrafast", audio_path=None,
+                      threads=0, start_number=None, frames=0, gop_size=0):
+    args = [FFMPEG_PATH, "-y"]
+    args.extend(["-framerate", str(framerate)])
+    if start_number is not None:
+        args.extend(["-start_number", str(start_number)])
+    args.extend(["-i", image_seq_path])
     if audio_path:
-        ffmpeg_cmd += ' -i {0}'.format(audio_path)
+        args.extend(["-i", audio_path])
 
-    ffmpeg_cmd += ' -c:v libx264 -crf {0} -preset {1}'.format(crf, preset)
+    args.extend(["-c:v", "libx264", "-crf", str(crf), "-preset", preset])
+    if frames:
+        args.extend(["-frames:v", str(frames)])
+    if gop_size:
+        args.extend(["-g", str(gop_size)])
+    if threads:
+        args.extend(["-threads", str(threads)])
     if audio_path:
-        ffmpeg_cmd += ' -c:a aac -filter_comp;ex "[1:0] aped" -shortest'
-    ffmpeg_cmd += ' {0}'.format(output_path)
+        args.extend(["-c:a", "aac", "-filter_complex", "[1:0]apad", "-shortest"])
+    args.append(output_path)
+
+    return args
+
+
+def encode_image_sequence(image_seq_path, output_path, framerate=24, crf=21, preset="ultrafast", audio_path=None,
+                          segments=0, frame_range=None, gop_size=GOP_SIZE, cache=None):
+    """
+    segments > 1 splits the frame range into that many GOP-aligned chunks, encodes them in
+    parallel and joins them without re-encoding, for long sequences at slow presets that a
+    single x264 process does not spread over all cores. frame_range is (first, last) and is
+    looked up on disk when not given.
+
+    cache is an optional transcode_cache.TranscodeCache; an encode of unchanged frames with
+    the same settings is then linked from the cache instead of run again.
+    """
+    key = None
+    if cache is not None:
+        params = {"framerate": framerate, "crf": crf, "preset": preset}
+        if segments > 1:
+            params.update(segments=segments, frame_range=frame_range, gop_size=gop_size)
+        key = _cache_key(cache, image_seq_path, audio_path, params)
+        if key is not None and cache.fetch(key, output_path):
+            print("{0} from cache".format(output_path))
+            return 0
+        transcode_cache.remove_output(output_path)
+
+    if segments > 1:
+        returncode = encode_segmented(image_seq_path, output_path, framerate, crf, preset, audio_path, segments,
+                                      frame_range, gop_size)
+    else:
+        ffmpeg_args = build_encode_args(image_seq_path, output_path, framerate, crf, preset, audio_path,
+                                        start_number=find_start_number(image_seq_path))
+
+        print(subprocess.list2cmdline(ffmpeg_args))
+        returncode = subprocess.call(ffmpeg_args)
+
+    if key is not None and returncode == 0:
+        _cache_store(cache, key, output_path, image_seq_path, audio_path, params)
+
+    return returncode
+
+
+def encode_segmented(image_seq_path, output_path, framerate=24, crf=21, preset="ultrafast", audio_path=None,
+                     segments=4, frame_range=None, gop_size=GOP_SIZE):
+    frame_range = frame_range or find_frame_range(image_seq_path)
+    if frame_range is None:
+        print("No frames found for {0}".format(image_seq_path))
+        return 1
+
+    first, last = frame_range
+    chunk_size = -(-(last - first + 1) // segments)
+    chunk_size = -(-chunk_size // gop_size) * gop_size  # every chunk but the last is whole GOPs
+
+    work_dir = tempfile.mkdtemp(prefix="segments_", dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        jobs = []
+        for start in range(first, last + 1, chunk_size):
+            jobs.append({
+                "image_seq_path": image_seq_path,
+                "output_path": os.path.join(work_dir, "segment_{0:04d}.mp4".format(len(jobs))),
+                "framerate": framerate,
+                "crf": crf,
+                "preset": preset,
+                "start_number": start,
+                "frames": min(chunk_size, last + 1 - start),
+                "gop_size": gop_size,
+            })
+
+        results = encode_batch(jobs, max_jobs=len(jobs),
+                               threads_per_job=max(1, (os.cpu_count() or 1) // len(jobs)))
+        for result in results:
+            if not result.ok:
+                print("Segment {0} failed: {1}".format(result.output_path, result.error))
+                return result.returncode
+
+        list_path = os.path.join(work_dir, "segments.txt")
+        with open(list_path, "w") as f:
+            for job in jobs:
+                f.write("file '{0}'\n".format(job["output_path"].replace("'", "'\\''")))
+
+        ffmpeg_args = [FFMPEG_PATH, "-y", "-f", "concat", "-safe", "0", "-i", list_path]
+        if audio_path:
+            ffmpeg_args.extend(["-i", audio_path])
+        ffmpeg_args.extend(["-c:v", "copy"])
+        if audio_path:
+            ffmpeg_args.extend(["-c:a", "aac", "-filter_complex", "[1:0]apad", "-shortest"])
+        ffmpeg_args.append(output_path)
+
+        print(subprocess.list2cmdline(ffmpeg_args))
+        return subprocess.call(ffmpeg_args)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def find_frame_range(image_seq_path):
+    """
+    (first, last) frame number of the files matching a printf pattern such as
+    "shot010.%04d.jpg", or None without any.
+    """
+    sequence = image_sequences.find_sequence(image_seq_path)
+    if sequence is None:
+        return None
+    if sequence.gaps():
+        print("{0} is missing frames {1}, ffmpeg stops at the first gap".format(
+            image_seq_path, ", ".join("{0}-{1}".format(*gap) for gap in sequence.gaps())))
+
+    return sequence.first, sequence.last
+
+
+def find_start_number(image_seq_path):
+    """
+    First frame of the sequence, which ffmpeg only finds by itself when it is 0 to 4.
+    """
+    sequence = image_sequences.find_sequence(image_seq_path)
+
+    return sequence.first if sequence is not None else None
+
+
+def encode_batch(jobs, max_jobs=0, threads_per_job=THREADS_PER_JOB, cache=None):
+    """
+    Encode many image sequences at once. jobs are dicts of build_encode_args() arguments,
+    e.g. {"image_seq_path": "shot010/shot010.%04d.jpg", "output_path": "shot010.mp4"}.
+
+    Each ffmpeg gets threads_per_job threads, unless its job sets "threads", and as many run
+    at a time as fit the cores, or max_jobs. Jobs found in cache, a
+    transcode_cache.TranscodeCache, are not run. Returns an EncodeResult per job, in job
+    order; a job that cannot run gets returncode -1 and the error instead of ending the batch.
+    """
+    threads_per_job = max(1, threads_per_job)
+    max_jobs = max_jobs or max(1, (os.cpu_count() or 1) // threads_per_job)
+
+    # the threads only wait on their ffmpeg process, the encoding itself runs in parallel
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        futures = [executor.submit(_run_encode, job, threads_per_job, cache) for job in jobs]
+
+    return [future.result() for future in futures]
+
+
+def _run_encode(job, threads, cache=None):
+    start = time.perf_counter()
+    try:
+        return _encode_job(job, threads, cache, start)
+    except Exception as e:  # e.g. an unknown argument, the other jobs still run
+        return EncodeResult(job.get("output_path"), -1, time.perf_counter() - start, str(e))
+
+
+def _encode_job(job, threads, cache, start):
+    job = dict(job)
+    threads = job.pop("threads", threads)
+
+    key = None
+    if cache is not None:
+        params = {name: value for name, value in job.items()
+                  if name not in ("image_seq_path", "output_path", "audio_path")}
+        params["threads"] = threads
+        key = _cache_key(cache, job["image_seq_path"], job.get("audio_path"), params)
+        if key is not None and cache.fetch(key, job["output_path"]):
+            return EncodeResult(job["output_path"], 0, time.perf_counter() - start)
+        transcode_cache.remove_output(job["output_path"])
+
+    if "start_number" not in job:
+        job["start_number"] = find_start_number(job["image_seq_path"])
+    ffmpeg_args = build_encode_args(threads=threads, **job)
+    ffmpeg_args[1:1] = ["-hide_banner", "-nostats", "-loglevel", "error"]  # keeps stderr to the errors
+
+    try:
+        process = subprocess.run(ffmpeg_args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE)
+    except OSError as e:
+        return EncodeResult(job["output_path"], -1, time.perf_counter() - start, str(e))
+
+    error = process.stderr.decode(errors="replace").strip() if process.returncode else ""
+    if key is not None and process.returncode == 0:
+        _cache_store(cache, key, job["output_path"], job["image_seq_path"], job.get("audio_path"), params)
+
+    return EncodeResult(job["output_path"], process.returncode, time.perf_counter() - start, error)
+
+
+def _cache_key(cache, image_seq_path, audio_path, params):
+    """
+    Cache key of an encode, None when the inputs cannot be read and the encode should just run.
+    """
+    inputs = [image_seq_path, audio_path] if audio_path else [image_seq_path]
+    try:
+        return cache.fingerprint(inputs, dict(params, ffmpeg=FFMPEG_PATH, codec="libx264"))
+    except OSError as e:
+        print("Not caching {0}: {1}".format(image_seq_path, e))
+        return None
+
+
+def _cache_store(cache, key, output_path, image_seq_path, audio_path, params):
+    if _cache_key(cache, image_seq_path, audio_path, params) != key:
+        print("Not caching {0}: the input changed during the encode".format(output_path))
+        return
 
-    print(ffmpeg_cmd)
-    subprocess.call(ffmpeg_cmd)
+    try:
+        cache.store(key, output_path)
+    except OSError as e:
+        print("Could not cache {0}: {1}".format(output_path, e))  # the encode itself succeeded
 
 
 if __name__ == "__main__":
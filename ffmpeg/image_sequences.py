@@ -0,0 +1,240 @@
+import collections
+import os
+import re
+import threading
+import time
+
+FRAME_RE = re.compile(r"^(.*?)(\d+)(\D*)$")  # head, frame number (the last digits), tail
+PATTERN_RE = re.compile(r"%0?(\d*)d|#+")  # printf or hash frame placeholder
+
+IMAGE_EXTENSIONS = (".exr", ".dpx", ".cin", ".jpg", ".jpeg", ".png", ".tif", ".tiff", ".tga", ".bmp", ".hdr",
+                    ".webp")
+
+
+class ImageSequence(object):
+    """
+    Numbered files sharing a head and tail, e.g. shot010.1001.exr to shot010.1100.exr. padding
+    is the zero-padded width of the frame numbers, 0 for unpadded ones.
+    """
+
+    def __init__(self, directory, head, tail, padding, frames):
+        self.directory = directory
+        self.head = head
+        self.tail = tail
+        self.padding = padding
+        self.frames = sorted(frames)
+
+    @property
+    def first(self):
+        return self.frames[0]
+
+    @property
+    def last(self):
+        return self.frames[-1]
+
+    def pattern(self):
+        """
+        printf pattern for ffmpeg, e.g. shot010.%04d.exr.
+        """
+        placeholder = "%0{0}d".format(self.padding) if self.padding > 1 else "%d"
+
+        return os.path.join(self.directory, self.head + placeholder + self.tail)
+
+    def path(self, frame):
+        return os.path.join(self.directory, "{0}{1:0{2}d}{3}".format(self.head, frame, self.padding, self.tail))
+
+    def ranges(self):
+        """
+        Contiguous (first, last) frame ranges.
+        """
+        ranges = []
+        start = previous = self.frames[0]
+        for frame in self.frames[1:]:
+            if frame != previous + 1:
+                ranges.append((start, previous))
+                start = frame
+            previous = frame
+        ranges.append((start, previous))
+
+        return ranges
+
+    def gaps(self):
+        """
+        (first, last) ranges of missing frames.
+        """
+        ranges = self.ranges()
+
+        return [(ranges[i][1] + 1, ranges[i + 1][0] - 1) for i in range(len(ranges) - 1)]
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __repr__(self):
+        return "ImageSequence({0!r}, {1}-{2}, {3} frames)".format(self.pattern(), self.first, self.last, len(self))
+
+
+class SequenceIndex(object):
+    """
+    Thread-safe cache of the image sequences per directory, keyed on the directory mtime,
+    which changes whenever a file is added, removed or renamed. Directories modified within
+    SETTLE_TIME are rescanned every time, since a coarse mtime cannot tell two changes in the
+    same tick apart.
+    """
+    MAX_DIRECTORIES = 4096
+    SETTLE_TIME = 2.0  # seconds
+
+    def __init__(self, max_directories=0):
+        self.max_directories = max_directories or self.MAX_DIRECTORIES
+
+        self.scans = 0  # directory listings actually read
+
+        self._entries = collections.OrderedDict()  # directory: (mtime_ns, sequences), least recently used first
+        self._lock = threading.Lock()
+
+    def sequences(self, directory):
+        directory = os.path.abspath(directory)
+        mtime = os.stat(directory).st_mtime_ns
+
+        with self._lock:
+            entry = self._entries.get(directory)
+            if entry is not None and entry[0] == mtime:
+                self._entries.move_to_end(directory)
+                return entry[1]
+
+        sequences = scan_directory(directory)
+        self.scans += 1
+
+        if time.time() - mtime / 1e9 > self.SETTLE_TIME:
+            with self._lock:
+                self._entries[directory] = (mtime, sequences)
+                self._entries.move_to_end(directory)
+                while len(self._entries) > self.max_directories:
+                    self._entries.popitem(last=False)
+
+        return sequences
+
+    def find(self, path, extensions=None):
+        """
+        The sequence of a frame path or printf/hash pattern, None if there are no such files.
+        extensions optionally limits the lookup to such files, e.g. IMAGE_EXTENSIONS so that
+        versioned movies like shot010_v003.mov are not taken for a sequence.
+        """
+        directory, name = os.path.split(os.path.abspath(path))
+        if extensions and not name.lower().endswith(extensions):
+            return None
+        try:
+            sequences = self.sequences(directory)
+        except OSError:
+            return None
+
+        match = PATTERN_RE.search(name)
+        if match is not None:
+            head, tail = name[:match.start()], name[match.end():]
+            if match.group(0).startswith("#"):
+                padding = len(match.group(0))
+            else:
+                padding = int(match.group(1) or 0)
+            for sequence in sequences:
+                if sequence.head == head and sequence.tail == tail and _names(padding, sequence):
+                    return sequence
+            return None
+
+        match = FRAME_RE.match(name)
+        if match is None:
+            return None
+        head, digits, tail = match.groups()
+        for sequence in sequences:
+            if sequence.head == head and sequence.tail == tail and _fits(digits, sequence.padding):
+                return sequence
+
+        return None
+
+    def invalidate(self, directory=None):
+        with self._lock:
+            if directory is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(os.path.abspath(directory), None)
+
+
+def _names(padding, sequence):
+    """
+    Whether a placeholder of padding digits names the frames of sequence. An unpadded %d or #
+    names any frames without leading zeros, e.g. 100-150 which scan as padding 3.
+    """
+    if padding > 1:
+        return sequence.padding == padding
+
+    return sequence.padding <= 1 or sequence.first >= 10 ** (sequence.padding - 1)
+
+
+def _fits(digits, padding):
+    if padding > 1:
+        return len(digits) >= padding and (len(digits) == padding or digits[0] != "0")
+
+    return digits == "0" or digits[0] != "0"
+
+
+def scan_directory(directory, extensions=None):
+    """
+    Group the numbered files of directory into ImageSequences, without caching. extensions
+    optionally limits the files, e.g. (".exr", ".jpg").
+
+    Frame numbers with leading zeros set the padding of their sequence; numbers without
+    them join a padded sequence if they are at least as wide, otherwise they form an
+    unpadded one (or a padded one when all are the same width, e.g. 1001-1100 is %04d).
+    """
+    groups = collections.defaultdict(list)  # (head, tail): [digits]
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if extensions and not entry.name.lower().endswith(extensions):
+                continue
+            match = FRAME_RE.match(entry.name)
+            if match is None or not entry.is_file():
+                continue
+            head, digits, tail = match.groups()
+            groups[(head, tail)].append(digits)
+
+    sequences = []
+    for (head, tail), numbers in groups.items():
+        frames = collections.defaultdict(list)  # padding: frames
+        widths = sorted({len(digits) for digits in numbers if len(digits) > 1 and digits[0] == "0"})
+        for digits in numbers:
+            if len(digits) > 1 and digits[0] == "0":
+                padding = len(digits)
+            else:
+                fitting = [width for width in widths if width <= len(digits)]
+                padding = fitting[-1] if fitting else -1  # -1: decided below
+            frames[padding].append(int(digits))
+
+        unpadded = frames.pop(-1, None)
+        if unpadded:
+            sizes = {len(str(frame)) for frame in unpadded}
+            padding = sizes.pop() if len(sizes) == 1 and not frames else 0
+            frames[padding].extend(unpadded)
+
+        for padding, numbers in frames.items():
+            sequences.append(ImageSequence(directory, head, tail, padding, numbers))
+
+    sequences.sort(key=lambda sequence: (sequence.head, sequence.tail, sequence.padding))
+
+    return sequences
+
+
+INDEX = SequenceIndex()
+
+
+def find_sequence(path, extensions=None):
+    """
+    Look up the sequence of a frame path or pattern in the shared INDEX.
+    """
+    return INDEX.find(path, extensions)
+
+
+if __name__ == "__main__":
+    import sys
+
+    for sequence in INDEX.sequences(sys.argv[1] if len(sys.argv) > 1 else "."):
+        gaps = ", ".join("{0}-{1}".format(*gap) for gap in sequence.gaps())
+        print("{0}  {1}-{2}  {3} frames{4}".format(sequence.pattern(), sequence.first, sequence.last, len(sequence),
+                                                   "  missing " + gaps if gaps else ""))
@@ -0,0 +1,62 @@
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+import ffmpeg_helpers
+
+
+def make_test_sequence(directory, frames, size):
+    """
+    Render a synthetic image sequence with ffmpeg's testsrc2, returns its printf pattern.
+    """
+    pattern = os.path.join(directory, "bench.%04d.png")
+    subprocess.check_call([ffmpeg_helpers.FFMPEG_PATH, "-hide_banner", "-loglevel", "error", "-y",
+                           "-f", "lavfi", "-i", "testsrc2=size={0}:rate=24".format(size),
+                           "-frames:v", str(frames), "-start_number", "1", pattern])
+
+    return pattern
+
+
+def time_encode(image_seq_path, output_path, preset, segments, frame_range):
+    start = time.perf_counter()
+    returncode = ffmpeg_helpers.encode_image_sequence(image_seq_path, output_path, preset=preset, segments=segments,
+                                                      frame_range=frame_range)
+    elapsed = time.perf_counter() - start
+    if returncode:
+        raise RuntimeError("ffmpeg failed with exit code {0}".format(returncode))
+
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Wall-clock time of segmented against single-process encodes")
+    parser.add_argument("--input", help="printf pattern of an existing sequence, a test sequence is rendered if not set")
+    parser.add_argument("--frames", type=int, default=960, help="frames of the rendered test sequence")
+    parser.add_argument("--size", default="1920x1080", help="resolution of the rendered test sequence")
+    parser.add_argument("--presets", nargs="+", default=["medium", "slow"])
+    parser.add_argument("--segments", type=int, nargs="+", default=[2, 4, 8])
+    parser.add_argument("--ffmpeg", default=ffmpeg_helpers.FFMPEG_PATH)
+    args = parser.parse_args()
+
+    ffmpeg_helpers.FFMPEG_PATH = args.ffmpeg
+    work_dir = tempfile.mkdtemp(prefix="segmented_benchmark_")
+    try:
+        image_seq_path = args.input or make_test_sequence(work_dir, args.frames, args.size)
+        frame_range = ffmpeg_helpers.find_frame_range(image_seq_path)
+        print("{0}: frames {1}-{2}, {3} cores".format(image_seq_path, frame_range[0], frame_range[1], os.cpu_count()))
+
+        for preset in args.presets:
+            output_path = os.path.join(work_dir, "single_{0}.mp4".format(preset))
+            single = time_encode(image_seq_path, output_path, preset, 0, frame_range)
+            print("{0:<10} single process  {1:8.2f} s".format(preset, single))
+
+            for segments in args.segments:
+                output_path = os.path.join(work_dir, "segmented_{0}_{1}.mp4".format(preset, segments))
+                segmented = time_encode(image_seq_path, output_path, preset, segments, frame_range)
+                print("{0:<10} {1:>2} segments     {2:8.2f} s  x{3:.2f}".format(preset, segments, segmented,
+                                                                            single / segmented))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+import image_sequences
+
+CACHE_DIR = os.environ.get("TRANSCODE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "transcode_cache"))
+
+SAMPLE_SIZE = 1024 * 1024  # bytes hashed per sample of a single-file input
+
+
+class TranscodeCache(object):
+    """
+    Content-addressed cache of encode outputs. The key is a fingerprint of the inputs (names,
+    sizes and mtimes of every frame, optionally hashes of sample_frames of them) and of every
+    encode parameter, so a repeated encode is served by a hard link, or a copy across
+    filesystems, instead of ffmpeg:
+
+        cache = TranscodeCache()
+        key = cache.fingerprint([image_seq_path], {"crf": 21, "preset": "slow", "ext": ".mp4"})
+        if not cache.fetch(key, output_path):
+            encode(...)
+            cache.store(key, output_path)
+
+    Outputs share their data with the cache, so encode to a fresh file rather than over a
+    fetched one; remove_output() does that. Least recently used entries are evicted once the
+    cache holds more than max_size bytes.
+    """
+    MAX_SIZE = 50 * 1024 ** 3
+    SAMPLE_FRAMES = 0  # frames of a sequence whose content is hashed too
+
+    def __init__(self, cache_dir=None, max_size=0, sample_frames=-1):
+        self.cache_dir = cache_dir or CACHE_DIR
+        self.max_size = max_size or self.MAX_SIZE
+        self.sample_frames = self.SAMPLE_FRAMES if sample_frames < 0 else sample_frames
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+
+    def fingerprint(self, input_paths, params):
+        """
+        Key for the inputs, files or image sequence patterns, and params, a JSON serializable
+        dict of everything else that changes the output.
+        """
+        digest = hashlib.sha256()
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        for input_path in input_paths:
+            digest.update(b"\0" + os.path.abspath(input_path).encode())
+            if os.path.isfile(input_path):
+                self._fingerprint_file(digest, input_path)
+            else:
+                self._fingerprint_sequence(digest, input_path)
+
+        return digest.hexdigest()
+
+    def fetch(self, key, output_path):
+        """
+        Put the cached output for key at output_path, returns False on a miss.
+        """
+        path = self._object_path(key, output_path)
+        if not os.path.isfile(path):
+            with self._lock:
+                self.misses += 1
+            return False
+
+        remove_output(output_path)
+        try:
+            _link_or_copy(path, output_path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return False  # evicted meanwhile
+
+        self._touch(path)
+        with self._lock:
+            self.hits += 1
+
+        return True
+
+    def store(self, key, output_path):
+        path = self._object_path(key, output_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        temp_path = "{0}.{1}.tmp".format(path, uuid.uuid4().hex)
+        try:
+            _link_or_copy(output_path, temp_path)
+            os.replace(temp_path, path)  # other processes never see a partial entry
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        self._touch(path)
+        self.evict()
+
+    def evict(self):
+        """
+        Drop least recently used entries until the cache is within max_size, returns the
+        bytes freed.
+        """
+        entries = []
+        total = 0
+        for directory, _, names in os.walk(os.path.join(self.cache_dir, "objects")):
+            for name in names:
+                if name.endswith((".used", ".tmp")):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    size = os.stat(path).st_size
+                except OSError:
+                    continue  # evicted by another process
+                try:
+                    used = os.stat(path + ".used").st_mtime
+                except OSError:
+                    used = 0.0
+                entries.append((used, size, path))
+                total += size
+
+        freed = 0
+        entries.sort()
+        while total > self.max_size and entries:
+            _, size, path = entries.pop(0)
+            for evicted_path in (path, path + ".used"):
+                try:
+                    os.remove(evicted_path)
+                except OSError:
+                    pass
+            total -= size
+            freed += size
+
+        return freed
+
+    def size(self):
+        return sum(os.path.getsize(os.path.join(directory, name))
+                   for directory, _, names in os.walk(os.path.join(self.cache_dir, "objects"))
+                   for name in names if not name.endswith((".used", ".tmp")))
+
+    def _object_path(self, key, output_path):
+        extension = os.path.splitext(output_path)[1]
+
+        return os.path.join(self.cache_dir, "objects", key[:2], key + extension)
+
+    def _touch(self, path):
+        """
+        Last use is recorded on a sidecar file, the object itself may be linked to an output
+        whose mtime must not change.
+        """
+        with open(path + ".used", "a"):
+            pass
+        os.utime(path + ".used")
+
+    def _fingerprint_file(self, digest, path):
+        stat = os.stat(path)
+        digest.update("{0} {1}".format(stat.st_size, stat.st_mtime_ns).encode())
+        if not self.sample_frames:
+            return
+
+        with open(path, "rb") as f:
+            for i in range(self.sample_frames):
+                f.seek(stat.st_size * i // self.sample_frames)
+                digest.update(f.read(SAMPLE_SIZE))
+
+    def _fingerprint_sequence(self, digest, pattern):
+        sequence = image_sequences.find_sequence(pattern)
+        if sequence is None:
+            raise FileNotFoundError("No input at {0}".format(pattern))
+
+        names = {os.path.basename(sequence.path(frame)): frame for frame in sequence.frames}
+        stats = {}
+        with os.scandir(sequence.directory) as entries:
+            for entry in entries:
+                if entry.name in names:
+                    stat = entry.stat()
+                    stats[names[entry.name]] = (stat.st_size, stat.st_mtime_ns)
+        for frame in sequence.frames:
+            digest.update("{0} {1} {2}\n".format(frame, *stats.get(frame, (-1, -1))).encode())
+
+        samples = min(self.sample_frames, len(sequence))
+        for i in range(samples):
+            with open(sequence.path(sequence.frames[i * len(sequence) // samples]), "rb") as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+
+
+def remove_output(output_path):
+    """
+    Unlink an old output before it is written again: truncating it in place would also
+    change a hard-linked cache entry.
+    """
+    try:
+        os.remove(output_path)
+    except FileNotFoundError:
+        pass
+
+
+def _link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
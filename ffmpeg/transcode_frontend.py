@@ -1,10 +1,117 @@
+import collections
 import os
-import subprocess
+import re
 import sys
+import traceback
 from PySide2 import QtGui
 from PySide2 import QtWidgets
 from PySide2 import QtCore
 
+import image_sequences
+import transcode_cache
+
+
+class FFmpegProgress(object):
+    """
+    Parses the key=value blocks ffmpeg writes with -progress pipe:1, and the input duration
+    from its log, into frame, fps, speed and ETA.
+    """
+    DURATION_RE = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+
+    def __init__(self):
+        self.duration = 0.0  # seconds of input, 0 while unknown
+        self.frame = 0
+        self.fps = 0.0
+        self.speed = 0.0  # multiple of realtime
+        self.out_time = 0.0  # seconds encoded so far
+        self.finished = False
+
+        self._values = {}
+        self._partial = ""
+
+    def feed_log(self, text):
+        if not self.duration:
+            match = self.DURATION_RE.search(text)
+            if match:
+                hours, minutes, seconds = match.groups()
+                self.duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+    def feed(self, text):
+        """
+        Add progress output, returns True when it completed a block and the values changed.
+        """
+        lines = (self._partial + text).split("\n")
+        self._partial = lines.pop()
+
+        updated = False
+        for line in lines:
+            key, _, value = line.strip().partition("=")
+            if key != "progress":
+                self._values[key] = value.strip()
+                continue
+
+            self.frame = int(self._number("frame"))
+            self.fps = self._number("fps")
+            self.speed = self._number("speed")
+            out_time_key = "out_time_us" if "out_time_us" in self._values else "out_time_ms"  # both microseconds
+            self.out_time = self._number(out_time_key) / 1e6
+            self.finished = value.strip() == "end"
+            updated = True
+
+        return updated
+
+    def fraction(self):
+        if self.finished:
+            return 1.0
+        if not self.duration:
+            return 0.0
+
+        return min(1.0, self.out_time / self.duration)
+
+    def eta(self):
+        """
+        Seconds left, or -1 while unknown.
+        """
+        if not (self.duration and self.speed):
+            return -1.0
+
+        return max(0.0, (self.duration - self.out_time) / self.speed)
+
+    def _number(self, key):
+        try:
+            return float(self._values.get(key, "").rstrip("x"))
+        except ValueError:  # "N/A" until ffmpeg knows
+            return 0.0
+
+
+class CacheTaskSignals(QtCore.QObject):
+    finished = QtCore.Signal(object, object)  # context, result
+
+
+class CacheTask(QtCore.QRunnable):
+    """
+    Runs function(*args) on a worker thread and emits finished(context, result) with the
+    result, or None if it raised. Cache lookups fingerprint every frame and a fetch or store
+    can copy a whole movie, which would freeze the window on the GUI thread.
+    """
+
+    def __init__(self, function, args, context=None):
+        super(CacheTask, self).__init__()
+
+        self.function = function
+        self.args = args
+        self.context = context
+        self.signals = CacheTaskSignals()  # created here, so it lives on the GUI thread
+
+    def run(self):
+        try:
+            result = self.function(*self.args)
+        except:
+            traceback.print_exc()
+            result = None
+
+        self.signals.finished.emit(self.context, result)
+
 
 class TranscodeWindow(QtWidgets.QWidget):
     FFMPEG_PATH = "P:/ffmpeg/bin/ffmpeg.exe"
@@ -29,12 +136,30 @@ class TranscodeWindow(QtWidgets.QWidget):
     ]
     PRESET_DEFAULT = "medium"
 
-    def __init__(self):
+    ERROR_LINES = 20  # lines of ffmpeg's log kept for the error message
+
+    def __init__(self, cache=None):
         super(TranscodeWindow, self).__init__(parent=None)
 
         self.setWindowTitle("FFmpeg Transcoder")
         self.setMinimumSize(400, 300)
 
+        self.cache = cache  # transcode_cache.TranscodeCache serving repeated transcodes
+        self.queue = collections.deque()  # (list item, ffmpeg args, cache entry) waiting to run
+        self.current_item = None
+        self.current_entry = None  # (cache key, input path, params) of the running transcode
+        self.progress = None
+        self.error_lines = collections.deque(maxlen=self.ERROR_LINES)
+        self.completed_count = 0
+        self.failed_count = 0
+        self.cancelled = False
+        self.queue_epoch = 0  # bumped by clear_queue(), drops cache lookups still running
+
+        self.process = QtCore.QProcess(self)
+
+        self.cache_pool = QtCore.QThreadPool(self)
+        self.cache_pool.setMaxThreadCount(1)  # lookups finish in order, stores land before later lookups
+
         self.create_widgets()
         self.create_layout()
         self.create_connections()
@@ -64,6 +189,15 @@ class TranscodeWindow(QtWidgets.QWidget):
         self.audio_codec_combo = QtWidgets.QComboBox()
         self.audio_codec_combo.addItem("aac", "aac")
 
+        self.queue_list = QtWidgets.QListWidget()
+        self.progress_bar = QtWidgets.QProgressBar()
+        self.progress_bar.setRange(0, 1000)
+        self.progress_bar.setTextVisible(False)
+        self.progress_label = QtWidgets.QLabel("Idle")
+        self.stop_btn = QtWidgets.QPushButton("Stop")
+        self.stop_btn.setEnabled(False)
+        self.clear_btn = QtWidgets.QPushButton("Clear Queue")
+
         self.transcode_btn = QtWidgets.QPushButton("Transcode")
         self.cancel_btn = QtWidgets.QPushButton("Cancel")
 
@@ -113,6 +247,18 @@ class TranscodeWindow(QtWidgets.QWidget):
         options_layout.addWidget(video_options_grp)
         options_layout.addWidget(audio_options_grp)
 
+        queue_grp = QtWidgets.QGroupBox("Queue")
+        queue_grp_layout = QtWidgets.QVBoxLayout()
+        queue_grp_layout.addWidget(self.queue_list)
+        queue_grp_layout.addWidget(self.progress_bar)
+        queue_buttons_layout = QtWidgets.QHBoxLayout()
+        queue_buttons_layout.addWidget(self.progress_label)
+        queue_buttons_layout.addStretch()
+        queue_buttons_layout.addWidget(self.stop_btn)
+        queue_buttons_layout.addWidget(self.clear_btn)
+        queue_grp_layout.addLayout(queue_buttons_layout)
+        queue_grp.setLayout(queue_grp_layout)
+
         button_layout = QtWidgets.QHBoxLayout()
         button_layout.addStretch()
         button_layout.addWidget(self.transcode_btn)
@@ -122,7 +268,7 @@ class TranscodeWindow(QtWidgets.QWidget):
         main_layout.addWidget(input_grp)
         main_layout.addWidget(output_grp)
         main_layout.addLayout(options_layout)
-        main_layout.addStretch()
+        main_layout.addWidget(queue_grp)
         main_layout.addLayout(button_layout)
 
     def create_connections(self):
@@ -132,6 +278,14 @@ class TranscodeWindow(QtWidgets.QWidget):
         self.transcode_btn.clicked.connect(self.transcode)
         self.cancel_btn.clicked.connect(self.close)
 
+        self.stop_btn.clicked.connect(self.stop_transcode)
+        self.clear_btn.clicked.connect(self.clear_queue)
+
+        self.process.readyReadStandardOutput.connect(self.on_progress_output)
+        self.process.readyReadStandardError.connect(self.on_log_output)
+        self.process.finished.connect(self.on_process_finished)
+        self.process.errorOccurred.connect(self.on_process_error)
+
     def set_input_path(self):
         filters = "*;; *.mp4;; *.mov;;"
         selected_filter = "*;; *.mp4;; *.mov;"
@@ -139,6 +293,9 @@ class TranscodeWindow(QtWidgets.QWidget):
         input_path, selected_filter = QtWidgets.QFileDialog.getOpenFileName(self, "Select an Input File", "", filters,
                                                                             selected_filter)
         if input_path:
+            sequence = image_sequences.find_sequence(input_path, image_sequences.IMAGE_EXTENSIONS)
+            if sequence is not None and len(sequence) > 1:
+                input_path = sequence.pattern()  # a frame of an image sequence stands for the whole sequence
             self.input_path_le.setText(input_path)
 
     def set_output_path(self):
@@ -156,9 +313,12 @@ class TranscodeWindow(QtWidgets.QWidget):
         if not input_path:
             QtWidgets.QMessageBox.critical(self, "Transcode Error", "Input path not set")
             return
+        sequence = None
         if not os.path.exists(input_path):
-            QtWidgets.QMessageBox.critical(self, "Transcode Error", "Input path does not exist")
-            return
+            sequence = image_sequences.find_sequence(input_path)
+            if sequence is None:
+                QtWidgets.QMessageBox.critical(self, "Transcode Error", "Input path does not exist")
+                return
 
         output_path = self.output_path_le.text()
         if not output_path:
@@ -171,16 +331,165 @@ class TranscodeWindow(QtWidgets.QWidget):
 
         audio_codec = self.audio_codec_combo.currentData()
 
-        args = [self.FFMPEG_PATH]  # executable path
-        args.extend(["-hide_banner", "-y"])  # global options
+        args = ["-hide_banner", "-y"]  # global options
+        args.extend(["-nostats", "-progress", "pipe:1"])  # progress as key=value blocks on stdout
+        if sequence is not None:
+            args.extend(["-start_number", str(sequence.first)])  # image sequence input options
         args.extend(["-i", input_path])  # input path
         args.extend(["-c:v", video_codec, "-crf", crf, "-preset", preset])  # video output options
         args.extend(["-c:a", audio_codec])  # audio output options
         args.append(output_path)  # output path
 
-        subprocess.call(args)
+        item = QtWidgets.QListWidgetItem("Queued: {0}".format(os.path.basename(output_path)))
+        item.setToolTip(output_path)
+        self.queue_list.addItem(item)
+
+        if self.cache is None:
+            self.queue.append((item, args, None))
+            self.start_next()
+            return
+
+        params = {"ffmpeg": self.FFMPEG_PATH, "video_codec": video_codec, "crf": crf, "preset": preset,
+                  "audio_codec": audio_codec, "start_number": sequence.first if sequence is not None else None}
+        item.setText("Checking cache: {0}".format(os.path.basename(output_path)))
+        task = CacheTask(self.fetch_cached, (input_path, params, output_path), (item, args, self.queue_epoch))
+        task.signals.finished.connect(self.on_cache_checked)
+        self.cache_pool.start(task)
+
+    def fetch_cached(self, input_path, params, output_path):
+        """
+        Runs on the cache thread: True when the output was served from the cache, otherwise
+        the (cache key, input path, params) entry to store the transcode under.
+        """
+        key = self.cache.fingerprint([input_path], params)
+        if self.cache.fetch(key, output_path):
+            return True
+
+        return key, input_path, params
+
+    def on_cache_checked(self, context, result):
+        item, args, epoch = context
+        if epoch != self.queue_epoch:
+            self.queue_list.takeItem(self.queue_list.row(item))
+            return
+
+        if result is True:
+            item.setText("Cached: {0}".format(os.path.basename(item.toolTip())))
+            return
+
+        item.setText("Queued: {0}".format(os.path.basename(item.toolTip())))
+        self.queue.append((item, args, result))  # result is None if the lookup failed, then nothing is cached
+        self.start_next()
+
+    def start_next(self):
+        """
+        Start the next queued transcode unless one is running; ffmpeg runs in a QProcess and
+        reports back through signals, so the event loop never blocks.
+        """
+        if self.process.state() != QtCore.QProcess.NotRunning:
+            return
+
+        if not self.queue:
+            self.current_item = None
+            self.stop_btn.setEnabled(False)
+            if self.completed_count or self.failed_count:
+                self.progress_label.setText("Done: {0} complete, {1} failed".format(self.completed_count,
+                                                                                 self.failed_count))
+                self.completed_count = self.failed_count = 0
+            return
+
+        self.current_item, args, self.current_entry = self.queue.popleft()
+        if self.cache is not None:
+            try:
+                transcode_cache.remove_output(args[-1])  # the old output may be linked to a cache entry
+            except OSError:
+                traceback.print_exc()
+        self.current_item.setText("Running: {0}".format(os.path.basename(args[-1])))
+        self.progress = FFmpegProgress()
+        self.error_lines.clear()
+        self.cancelled = False
+
+        self.progress_bar.setValue(0)
+        self.progress_label.setText("Starting")
+        self.stop_btn.setEnabled(True)
+
+        self.process.start(self.FFMPEG_PATH, args)
+
+    def stop_transcode(self):
+        """
+        Cancel the running transcode, the queue carries on.
+        """
+        if self.process.state() != QtCore.QProcess.NotRunning:
+            self.cancelled = True
+            self.process.kill()
+
+    def clear_queue(self):
+        self.queue_epoch += 1
+        while self.queue:
+            item, _, _ = self.queue.popleft()
+            self.queue_list.takeItem(self.queue_list.row(item))
+
+    def on_progress_output(self):
+        text = bytes(self.process.readAllStandardOutput()).decode(errors="replace")
+        if not self.progress.feed(text):
+            return
 
-        QtWidgets.QMessageBox.information(self, "Transcode Complete", "File transcode operation complete.")
+        self.progress_bar.setValue(int(self.progress.fraction() * 1000))
+
+        eta = self.progress.eta()
+        self.progress_label.setText("frame {0}  {1:.1f} fps  {2:.2f}x  ETA {3}".format(
+            self.progress.frame, self.progress.fps, self.progress.speed,
+            "{0}:{1:02d}".format(int(eta) // 60, int(eta) % 60) if eta >= 0 else "?"))
+
+    def on_log_output(self):
+        text = bytes(self.process.readAllStandardError()).decode(errors="replace")
+        self.progress.feed_log(text)
+        self.error_lines.extend(line for line in text.splitlines() if line.strip())
+
+    def on_process_finished(self, exit_code, exit_status):
+        name = os.path.basename(self.current_item.toolTip())
+        if self.cancelled:
+            self.current_item.setText("Cancelled: {0}".format(name))
+        elif exit_status == QtCore.QProcess.NormalExit and exit_code == 0:
+            self.current_item.setText("Complete: {0}".format(name))
+            self.progress_bar.setValue(1000)
+            self.completed_count += 1
+            if self.current_entry is not None:
+                self.cache_pool.start(CacheTask(self.store_output, (self.current_entry, self.current_item.toolTip())))
+        else:
+            self.current_item.setText("Failed: {0}".format(name))
+            self.current_item.setToolTip("\n".join(self.error_lines))
+            self.failed_count += 1
+
+        self.start_next()
+
+    def store_output(self, entry, output_path):
+        """
+        Runs on the cache thread: cache the finished output, unless its input changed since
+        the transcode was queued.
+        """
+        key, input_path, params = entry
+        if self.cache.fingerprint([input_path], params) == key:
+            self.cache.store(key, output_path)
+
+    def on_process_error(self, error):
+        if error != QtCore.QProcess.FailedToStart:
+            return  # crashes and kills also end in finished()
+
+        self.current_item.setText("Failed: {0}".format(os.path.basename(self.current_item.toolTip())))
+        self.failed_count += 1
+        QtWidgets.QMessageBox.critical(self, "Transcode Error", "Could not start {0}".format(self.FFMPEG_PATH))
+
+        self.start_next()
+
+    def closeEvent(self, event):
+        self.clear_queue()
+        self.stop_transcode()
+        self.process.waitForFinished(3000)
+        self.cache_pool.clear()  # pending lookups and stores; a running one is waited for
+        self.cache_pool.waitForDone()
+
+        super(TranscodeWindow, self).closeEvent(event)
 
 
 if __name__ == "__main__":
@@ -202,7 +511,7 @@ if __name__ == "__main__":
     # dark_palette.setColor(QtGui.QPalette.Highlight, QtCore.Qt.black)
     # app.setPalette(dark_palette)
 
-    window = TranscodeWindow()
+    window = TranscodeWindow(transcode_cache.TranscodeCache())
     window.show()
 
     app.exec_()